@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class CollabPocApp(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "collab_poc_app"
+
+    def ready(self):
+        from collab_poc_app import signals  # noqa: F401
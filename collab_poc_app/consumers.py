@@ -6,8 +6,8 @@ from collab_poc_app.models import TestDoc
 from pycrdt_model.consumers import YjsUpdateConsumer
 
 class TestDocUpdateConsumer(YjsUpdateConsumer[TestDoc]):
-    def __init__(self, worker_channel_name: str):
-        super().__init__(TestDoc, worker_channel_name)
+    def __init__(self, worker_channel_name: str, worker_shards: int = 1):
+        super().__init__(TestDoc, worker_channel_name, worker_shards)
 
     async def get_ydoc_model_object(self) -> TestDoc | None:
         user: User | None = self.scope["user"]
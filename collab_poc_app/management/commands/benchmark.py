@@ -0,0 +1,388 @@
+import asyncio
+from datetime import datetime, timezone
+from importlib import metadata
+import json
+import logging
+import platform
+import random
+import statistics
+import time
+from typing import Any, Callable
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import ApplicationCommunicator, WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+import pycrdt
+
+from collab_poc_app import synthetic
+from collab_poc_app.consumers import TestDocUpdateConsumer
+from collab_poc_app.models import TestDoc
+from collab_poc_app.tiptap_to_html import TiptapToHtml
+from collab_poc_app.views import observe_history
+from pycrdt_model.consumers import YjsSaverWorkerConsumer, _PendingState
+from pycrdt_model.models import History
+
+BENCHMARKS = ["tiptap", "consumer", "worker", "replay"]
+# Ones that need the database and channel layer
+DATABASE_BENCHMARKS = {"consumer", "worker", "replay"}
+
+WORKER_CHANNEL_NAME = "yjs-save-benchmark"
+CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+        # Every update is broadcast to every client, so the default of 100 would drop messages
+        "CONFIG": {"capacity": 1_000_000},
+    }
+}
+
+
+def measure(func: Callable[[], object], repeat: int) -> float:
+    """
+    Runs `func` `repeat` times and returns the median time, in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs performance benchmarks on synthetic documents. Benchmarks that need a database use a "
+        "temporary test database and the in-memory channel layer."
+    )
+
+    results: list[dict[str, Any]]
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--benchmarks",
+            nargs="+",
+            choices=BENCHMARKS,
+            default=BENCHMARKS,
+            help="Benchmarks to run (default: all)",
+        )
+        parser.add_argument(
+            "--sizes",
+            type=int,
+            nargs="+",
+            default=[100, 1000, 5000],
+            help="Document sizes to benchmark, in blocks",
+        )
+        parser.add_argument("--edits", type=int, default=50, help="Edits per diff")
+        parser.add_argument(
+            "--clients",
+            type=int,
+            nargs="+",
+            default=[1, 10, 50],
+            help="Numbers of websocket clients editing one document",
+        )
+        parser.add_argument(
+            "--messages", type=int, default=20, help="Updates sent by each client"
+        )
+        parser.add_argument(
+            "--docs",
+            type=int,
+            nargs="+",
+            default=[1, 10, 100],
+            help="Numbers of documents flushed by the saver worker at once",
+        )
+        parser.add_argument(
+            "--history-lengths",
+            type=int,
+            nargs="+",
+            default=[100, 1000, 5000],
+            help="Numbers of history entries to replay",
+        )
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--json",
+            dest="json_path",
+            metavar="PATH",
+            help="Also write the results to this file as JSON, or to standard output with '-'",
+        )
+
+    def handle(
+        self, *args, benchmarks: list[str], seed: int, json_path: str | None, **options
+    ):
+        self.results = []
+        self.quiet = json_path == "-"
+        # Debug logging of every update would dominate the timings
+        loggers = [logging.getLogger(name) for name in ("pycrdt_model", "collab_poc_app")]
+        levels = [logger.level for logger in loggers]
+        for logger in loggers:
+            logger.setLevel(logging.WARNING)
+        try:
+            self.run_benchmarks(benchmarks, seed, **options)
+        finally:
+            for logger, level in zip(loggers, levels):
+                logger.setLevel(level)
+
+        if json_path is not None:
+            self.write_json(json_path, benchmarks, seed, options)
+
+    def run_benchmarks(
+        self,
+        benchmarks: list[str],
+        seed: int,
+        *,
+        sizes: list[int],
+        edits: int,
+        clients: list[int],
+        messages: int,
+        docs: list[int],
+        history_lengths: list[int],
+        repeat: int,
+        **options,
+    ) -> None:
+        if "tiptap" in benchmarks:
+            for size in sizes:
+                self.bench_tiptap(size, edits, repeat, random.Random(seed))
+        if not DATABASE_BENCHMARKS.intersection(benchmarks):
+            return
+
+        with override_settings(CHANNEL_LAYERS=CHANNEL_LAYERS):
+            old_name = connection.creation.create_test_db(
+                verbosity=0, autoclobber=True, serialize=False
+            )
+            try:
+                if "consumer" in benchmarks:
+                    for count in clients:
+                        async_to_sync(self.bench_consumer)(count, messages, random.Random(seed))
+                if "worker" in benchmarks:
+                    for count in docs:
+                        async_to_sync(self.bench_worker)(count, repeat, random.Random(seed))
+                if "replay" in benchmarks:
+                    for length in history_lengths:
+                        self.bench_replay(length, repeat, random.Random(seed))
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def record(self, benchmark: str, params: dict[str, Any], metrics: dict[str, float]) -> None:
+        """
+        Adds a result, and prints it unless the JSON goes to standard output.
+
+        Metric names end with their unit, e.g. `render_ms` or `updates_per_s`.
+        """
+        self.results.append({"benchmark": benchmark, "params": params, "metrics": metrics})
+        if not self.quiet:
+            self.stdout.write(
+                "{} {}: {}".format(
+                    benchmark,
+                    " ".join(f"{key}={value}" for key, value in params.items()),
+                    ", ".join(f"{key} {value:.2f}" for key, value in metrics.items()),
+                )
+            )
+
+    def write_json(self, path: str, benchmarks: list[str], seed: int, options: dict) -> None:
+        output = {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                **{
+                    package: metadata.version(package)
+                    for package in ("django", "channels", "pycrdt")
+                },
+            },
+            "options": {
+                "benchmarks": benchmarks,
+                "seed": seed,
+                **{
+                    key: options[key]
+                    for key in (
+                        "sizes", "edits", "clients", "messages", "docs", "history_lengths", "repeat"
+                    )
+                },
+            },
+            "results": self.results,
+        }
+        if path == "-":
+            self.stdout.write(json.dumps(output, indent=2))
+        else:
+            with open(path, "w") as f:
+                json.dump(output, f, indent=2)
+
+    def bench_tiptap(self, size: int, edits: int, repeat: int, rng: random.Random) -> None:
+        """
+        Times rendering a document to HTML, and rendering the diff markup of a batch of edits to it.
+        """
+        doc = pycrdt.Doc()
+        frag = doc.get("contents", type=pycrdt.XmlFragment)
+        synthetic.fill_document(frag, rng, size)
+
+        edited_doc = pycrdt.Doc()
+        edited_doc.apply_update(doc.get_update())
+        state = edited_doc.get_state()
+        edited_frag = edited_doc.get("contents", type=pycrdt.XmlFragment)
+        for _ in range(edits):
+            synthetic.random_edit(edited_frag, rng, structural=False)
+        edit_update = edited_doc.get_update(state)
+
+        render_time = measure(lambda: str(TiptapToHtml(frag)), repeat)
+        stream_time = measure(lambda: next(TiptapToHtml.stream(frag)), repeat)
+
+        diff_times = []
+        for _ in range(repeat):
+            diff_doc = pycrdt.Doc()
+            diff_doc.apply_update(doc.get_update())
+            diff_frag = diff_doc.get("contents", type=pycrdt.XmlFragment)
+            events = observe_history(diff_frag)
+            start = time.perf_counter()
+            html = TiptapToHtml(diff_frag)
+            # Not timed: applying the update itself
+            pause = time.perf_counter()
+            diff_doc.apply_update(edit_update)
+            resume = time.perf_counter()
+            for is_text, path, delta, keys in events:
+                if is_text:
+                    html.apply_text_event(path, delta)
+                else:
+                    html.apply_element_event(path, delta, keys)
+            str(html)
+            diff_times.append(time.perf_counter() - resume + pause - start)
+        diff_time = statistics.median(diff_times)
+
+        self.record(
+            "tiptap",
+            {"size": size, "edits": edits},
+            {
+                "render_ms": render_time * 1000,
+                "first_chunk_ms": stream_time * 1000,
+                "diff_ms": diff_time * 1000,
+            },
+        )
+
+    async def bench_consumer(self, clients: int, messages: int, rng: random.Random) -> None:
+        """
+        Times `clients` websocket clients of one document each sending `messages` updates, until every
+        client has received every update broadcast to the room.
+        """
+        user = await User.objects.acreate(username=f"benchmark-{clients}")
+        obj = await TestDoc.objects.acreate()
+        app = TestDocUpdateConsumer.as_asgi(worker_channel_name=WORKER_CHANNEL_NAME)
+        communicators = []
+        for _ in range(clients):
+            communicator = WebsocketCommunicator(app, f"/ws/doc/{obj.pk}")
+            communicator.scope["user"] = user
+            communicator.scope["url_route"] = {"kwargs": {"pk": str(obj.pk)}}
+            connected, _ = await communicator.connect()
+            assert connected
+            # Initial sync step 1
+            await communicator.receive_from()
+            communicators.append(communicator)
+        client_messages = [
+            [
+                pycrdt.create_update_message(update)
+                for update in synthetic.random_updates(rng, messages, structural=False)
+            ]
+            for _ in range(clients)
+        ]
+
+        async def send_all(communicator: WebsocketCommunicator, updates: list[bytes]) -> None:
+            for update in updates:
+                await communicator.send_to(bytes_data=update)
+
+        async def receive_all(communicator: WebsocketCommunicator) -> None:
+            for _ in range(clients * messages):
+                await communicator.receive_from(timeout=10)
+
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(send_all(c, updates) for c, updates in zip(communicators, client_messages)),
+            *(receive_all(c) for c in communicators),
+        )
+        elapsed = time.perf_counter() - start
+
+        for communicator in communicators:
+            await communicator.disconnect()
+        # Drop the updates sent to the worker, which isn't running
+        await get_channel_layer().flush()
+
+        self.record(
+            "consumer",
+            {"clients": clients, "messages": messages},
+            {
+                "total_ms": elapsed * 1000,
+                "updates_per_s": clients * messages / elapsed,
+                "broadcasts_per_s": clients * clients * messages / elapsed,
+            },
+        )
+
+    async def bench_worker(self, docs: int, repeat: int, rng: random.Random) -> None:
+        """
+        Times the saver worker flushing pending updates to `docs` documents, from the flush messages until
+        they are saved. Includes the worker's `batch_flush_window`.
+        """
+        # Number of states saved by each flush
+        saved: asyncio.Queue[int] = asyncio.Queue()
+
+        class Worker(YjsSaverWorkerConsumer):
+            async def flush_states(self, states: list[_PendingState]) -> None:
+                await super().flush_states(states)
+                saved.put_nowait(len(states))
+
+        objs = [await TestDoc.objects.acreate() for _ in range(docs)]
+        clients = [pycrdt.Doc() for _ in objs]
+        worker = ApplicationCommunicator(
+            Worker.as_asgi(), {"type": "channel", "channel": WORKER_CHANNEL_NAME}
+        )
+        times = []
+        for _ in range(repeat):
+            flushes = []
+            for i, (obj, client) in enumerate(zip(objs, clients)):
+                state = client.get_state()
+                synthetic.random_edit(client.get("contents", type=pycrdt.XmlFragment), rng)
+                message = {
+                    "connection_id": f"connection-{i}",
+                    "model_app": TestDoc._meta.app_label,
+                    "model_name": TestDoc._meta.model_name,
+                    "model_pk": str(obj.pk),
+                    "user_pk": None,
+                }
+                await worker.send_input(
+                    {"type": "doc_updated", "update_bytes": client.get_update(state), **message}
+                )
+                flushes.append({"type": "doc_flush", **message})
+
+            start = time.perf_counter()
+            for flush in flushes:
+                await worker.send_input(flush)
+            remaining = docs
+            while remaining > 0:
+                remaining -= await asyncio.wait_for(saved.get(), 30)
+            times.append(time.perf_counter() - start)
+        worker.stop()
+
+        self.record(
+            "worker",
+            {"docs": docs, "batch_flush_window_ms": (Worker.batch_flush_window or 0) * 1000},
+            {"flush_ms": statistics.median(times) * 1000},
+        )
+
+    def bench_replay(self, length: int, repeat: int, rng: random.Random) -> None:
+        """
+        Times `History.replay` of a document with `length` history entries, to the latest and to the middle
+        entry.
+        """
+        obj = TestDoc.objects.create()
+        entries = [History(update=update) for update in synthetic.random_updates(rng, length)]
+        # Saved in chunks, so snapshots are taken as `YDocModelWithHistory.save` would
+        chunk = obj.history_snapshot_every_entries or length
+        for i in range(0, length, chunk):
+            History.save_entries([(obj, entries[i : i + chunk])])
+
+        latest_time = measure(lambda: History.replay(obj, entries[-1].id), repeat)
+        middle_time = measure(lambda: History.replay(obj, entries[length // 2].id), repeat)
+        self.record(
+            "replay",
+            {"entries": length},
+            {"latest_ms": latest_time * 1000, "middle_ms": middle_time * 1000},
+        )
@@ -0,0 +1,172 @@
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Callable
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+import pycrdt
+
+from collab_poc_app import synthetic
+from collab_poc_app.models import TestDoc
+from pycrdt_model.models import History
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates TestDocs with synthetic content and long multi-author edit histories, for scale testing. "
+        "The same seed always generates the same content, authors and edits, though not byte-identical "
+        "updates, as pycrdt encodes formatting attributes in hash order."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--docs", type=int, default=1, help="Documents to create")
+        parser.add_argument(
+            "--entries",
+            type=int,
+            default=1000,
+            help="History entries per document, including the initial content",
+        )
+        parser.add_argument(
+            "--blocks", type=int, default=50, help="Blocks of initial content per document"
+        )
+        parser.add_argument(
+            "--authors",
+            type=int,
+            default=3,
+            help="Users editing each document, created as synthetic-author-<n> if needed",
+        )
+        parser.add_argument(
+            "--days",
+            type=float,
+            default=30,
+            help="Spread the history entries' times over this many days up to now",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(
+        self,
+        *args,
+        docs: int,
+        entries: int,
+        blocks: int,
+        authors: int,
+        days: float,
+        seed: int,
+        **options,
+    ):
+        rng = random.Random(seed)
+        users = [
+            User.objects.get_or_create(username=f"synthetic-author-{i}")[0]
+            for i in range(authors)
+        ]
+        for i in range(docs):
+            start = time.perf_counter()
+            obj = self.generate_doc(f"Synthetic {seed}-{i}", users, entries, blocks, days, rng)
+            self.stdout.write(
+                f"Created {obj.get_absolute_url()} with {History.for_object(obj).count()} history "
+                f"entries in {time.perf_counter() - start:.1f} s"
+            )
+
+    @transaction.atomic
+    def generate_doc(
+        self,
+        name: str,
+        users: list[User],
+        entries: int,
+        blocks: int,
+        days: float,
+        rng: random.Random,
+    ) -> TestDoc:
+        """
+        Creates a document, then has `users` edit it in sessions of a few turns each, each turn saved as one
+        history entry.
+
+        Each user edits their own replica, brought up to date with everyone else's turns at the start of their
+        session, as a client would be when it reconnects. A turn's entry is the update of its transaction,
+        which only carries what the turn changed, so making and applying it doesn't get slower as the
+        document grows. Entries are saved by `save_chunk` in chunks of `history_snapshot_every_entries`,
+        through `History.save_entries`, so snapshots are taken as they would be for edits. The document itself is saved once, at the end, with entries' times spread evenly over `days`.
+        """
+        obj = TestDoc.objects.create()
+        # Fixed client IDs, since they end up in the updates
+        replicas = [pycrdt.Doc(client_id=rng.getrandbits(32)) for _ in users]
+        # Roots can't be got inside a transaction
+        frags = [replica.get("contents", type=pycrdt.XmlFragment) for replica in replicas]
+        fields = replicas[0].get("non_collab_fields", type=pycrdt.Map)
+        captured: list[bytes] = []
+        for replica in replicas:
+            replica.observe(lambda event: captured.append(event.update))
+        # The server's copy, for the final state
+        doc = pycrdt.Doc(client_id=0)
+        # Entries each replica has seen, by index into `updates`
+        seen = [0] * len(replicas)
+        updates: list[tuple[int, bytes]] = []
+
+        def take_turn(author: int, edit: Callable[[pycrdt.XmlFragment], None]) -> None:
+            replica = replicas[author]
+            state = replica.get_state()
+            captured.clear()
+            with replica.transaction():
+                edit(frags[author])
+            # Deletions alone don't change the state vector, so wouldn't make an entry when saved
+            while replica.get_state() == state:
+                with replica.transaction():
+                    synthetic.random_edit(frags[author], rng)
+            update = captured[0] if len(captured) == 1 else pycrdt.merge_updates(*captured)
+            doc.apply_update(update)
+            updates.append((author, update))
+            seen[author] = len(updates)
+
+        def initial_content(frag: pycrdt.XmlFragment) -> None:
+            fields["name"] = name
+            synthetic.fill_document(frag, rng, blocks)
+
+        def random_edits(frag: pycrdt.XmlFragment) -> None:
+            for _ in range(rng.randint(1, 3)):
+                synthetic.random_edit(frag, rng)
+
+        take_turn(0, initial_content)
+        chunk_size = obj.history_snapshot_every_entries or 100
+        start_time = timezone.now() - timedelta(days=days)
+        saved = 0
+        author = 0
+        session_turns = 0
+        while saved < entries:
+            if len(updates) < entries:
+                if session_turns == 0:
+                    author = rng.randrange(len(users))
+                    session_turns = rng.randint(1, 20)
+                    for other, update in updates[seen[author] :]:
+                        if other != author:
+                            replicas[author].apply_update(update)
+                    seen[author] = len(updates)
+                session_turns -= 1
+                take_turn(author, random_edits)
+                if len(updates) - saved < chunk_size and len(updates) < entries:
+                    continue
+
+            self.save_chunk(
+                obj,
+                [(users[update_author], update) for update_author, update in updates[saved:]],
+                start_time + timedelta(days=days) * len(updates) / entries,
+            )
+            saved = len(updates)
+
+        # Assigned, so saving doesn't record it as another history entry
+        obj.yjs_doc = doc
+        obj.save()
+        return obj
+
+    @staticmethod
+    def save_chunk(obj: TestDoc, entries: list[tuple[User, bytes]], at: datetime) -> None:
+        """
+        Saves history entries of `obj`, all at `at`, with `History.save_entries`, which also takes a
+        snapshot if one is due.
+        """
+        history = [History(author=author, update=update) for author, update in entries]
+        History.save_entries([(obj, history)])
+        # `time` is set on insert, so is overwritten afterwards
+        History.objects.filter(id__gte=history[0].id, id__lte=history[-1].id).update(time=at)
@@ -23,7 +23,8 @@ class TestDoc(YDocModelWithHistory):
         return reverse("detail", kwargs={"pk": self.pk})
 
     def __str__(self):
-        return self.name
+        # Stored copy, so listing docs doesn't need to decode them
+        return self.stored_name or ""
 
     def __repr__(self):
         return "TestDoc(name={!r}, score={!r}, description={!r}, contents={!r})".format(
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import re_path
 
 from collab_poc_app.consumers import TestDocUpdateConsumer
@@ -8,6 +9,7 @@ websocket_urlpatterns = [
         r"ws/doc/(?P<pk>[0-9]+)$",
         TestDocUpdateConsumer.as_asgi(
             worker_channel_name=DEFAULT_WORKER_CHANNEL_NAME,
+            worker_shards=settings.YJS_SAVE_WORKER_SHARDS,
         ),
     ),
 ]
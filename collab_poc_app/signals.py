@@ -0,0 +1,22 @@
+from django.core.cache import cache
+from django.dispatch import receiver
+
+from collab_poc_app.models import TestDoc
+from collab_poc_app.views import history_diff_cache_key, history_view_cache_key
+from pycrdt_model.signals import history_squashed
+
+
+@receiver(history_squashed)
+def invalidate_squashed_history_diffs(sender, history_ids: list[int], **kwargs) -> None:
+    """
+    Drops the cached diffs and details of squashed history entries, since they now cover the entries merged
+    into them.
+    """
+    cache.delete_many(
+        [
+            history_diff_cache_key(history_id, name)
+            for history_id in history_ids
+            for name, _ in TestDoc.RICH_TEXT_FIELDS
+        ]
+        + [history_view_cache_key(history_id) for history_id in history_ids]
+    )
@@ -0,0 +1,146 @@
+"""
+Deterministic synthetic Tiptap content and edits, for benchmarks and scale testing.
+
+Everything here is driven by a `random.Random`, so the same seed always produces the same document.
+"""
+
+import random
+from typing import Any, Iterator
+import pycrdt
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut "
+    "labore et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris "
+    "nisi aliquip ex ea commodo consequat duis aute irure in reprehenderit voluptate velit esse"
+).split()
+
+MARKS = ["bold", "italic", "underline", "strike", "code"]
+
+
+def random_words(rng: random.Random, min_words: int = 3, max_words: int = 12) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))) + " "
+
+
+def random_marks(rng: random.Random) -> dict[str, Any] | None:
+    roll = rng.random()
+    if roll < 0.6:
+        return None
+    if roll < 0.95:
+        return {rng.choice(MARKS): True}
+    return {"link": "https://example.com/" + rng.choice(WORDS)}
+
+
+def fill_text(text: pycrdt.XmlText, rng: random.Random, runs: int) -> None:
+    """
+    Appends `runs` runs of words, each with random formatting, to an integrated `XmlText`.
+    """
+    for _ in range(runs):
+        text.insert(len(text), random_words(rng), random_marks(rng))
+
+
+def append_paragraph(
+    parent: pycrdt.XmlFragment | pycrdt.XmlElement, rng: random.Random, runs: int = 4
+) -> pycrdt.XmlElement:
+    attrs = {"textAlign": rng.choice(["left", "center", "right"])} if rng.random() < 0.1 else {}
+    paragraph = parent.children.append(
+        pycrdt.XmlElement("paragraph", attrs, [pycrdt.XmlText()])
+    )
+    fill_text(paragraph.children[0], rng, runs)
+    return paragraph
+
+
+def append_block(parent: pycrdt.XmlFragment, rng: random.Random) -> None:
+    """
+    Appends a random block: mostly paragraphs, with some lists, tables, quotes and code blocks.
+    """
+    roll = rng.random()
+    if roll < 0.7:
+        append_paragraph(parent, rng, rng.randint(1, 8))
+    elif roll < 0.8:
+        tag = rng.choice(["bulletList", "orderedList"])
+        block = parent.children.append(pycrdt.XmlElement(tag, {}, []))
+        for _ in range(rng.randint(2, 5)):
+            item = block.children.append(pycrdt.XmlElement("listItem", {}, []))
+            append_paragraph(item, rng, rng.randint(1, 3))
+    elif roll < 0.88:
+        block = parent.children.append(pycrdt.XmlElement("table", {}, []))
+        columns = rng.randint(2, 4)
+        for row_index in range(rng.randint(2, 5)):
+            row = block.children.append(pycrdt.XmlElement("tableRow", {}, []))
+            for _ in range(columns):
+                cell = row.children.append(
+                    pycrdt.XmlElement("tableHeader" if row_index == 0 else "tableCell", {}, [])
+                )
+                append_paragraph(cell, rng, 1)
+    elif roll < 0.95:
+        block = parent.children.append(pycrdt.XmlElement("blockquote", {}, []))
+        append_paragraph(block, rng, rng.randint(1, 4))
+    else:
+        parent.children.append(
+            pycrdt.XmlElement("codeBlock", {}, [pycrdt.XmlText(random_words(rng))])
+        )
+
+
+def fill_document(frag: pycrdt.XmlFragment, rng: random.Random, blocks: int) -> None:
+    for _ in range(blocks):
+        append_block(frag, rng)
+
+
+def _random_text(frag: pycrdt.XmlFragment, rng: random.Random) -> pycrdt.XmlText | None:
+    """
+    Picks a random text node, descending into random children.
+    """
+    node: Any = frag
+    while not isinstance(node, pycrdt.XmlText):
+        # Indexed rather than listed, since iterating the children view is quadratic
+        children = node.children
+        count = len(children)
+        if not count:
+            return None
+        node = children[rng.randrange(count)]
+    return node
+
+
+def random_edit(
+    frag: pycrdt.XmlFragment, rng: random.Random, structural: bool = True
+) -> None:
+    """
+    Makes one random edit, of the kind a user would: typing, deleting, formatting, or (if `structural`)
+    adding and removing blocks.
+    """
+    roll = rng.random()
+    if len(frag.children) == 0 or (structural and roll < 0.05):
+        append_block(frag, rng)
+        return
+    if structural and roll < 0.08 and len(frag.children) > 1:
+        del frag.children[rng.randrange(len(frag.children))]
+        return
+
+    text = _random_text(frag, rng)
+    if text is None:
+        return
+    length = len(text)
+    if roll < 0.6 or length < 2:
+        text.insert(rng.randint(0, length), random_words(rng, 1, 3), random_marks(rng))
+    elif roll < 0.85:
+        start = rng.randrange(length - 1)
+        del text[start : min(length, start + rng.randint(1, 10))]
+    else:
+        start = rng.randrange(length - 1)
+        text.format(
+            start, min(length, start + rng.randint(1, 20)), {rng.choice(MARKS): True}
+        )
+
+
+def random_updates(
+    rng: random.Random, count: int, structural: bool = True
+) -> Iterator[bytes]:
+    """
+    Yields `count` updates to one document, starting from empty, each made by a `random_edit`.
+    """
+    doc = pycrdt.Doc()
+    frag = doc.get("contents", type=pycrdt.XmlFragment)
+    for _ in range(count):
+        state = doc.get_state()
+        random_edit(frag, rng, structural)
+        yield doc.get_update(state)
@@ -1,6 +1,40 @@
-from django.test import TestCase
+import asyncio
+from datetime import timedelta
+from io import StringIO
+import json
+from unittest import mock
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import ApplicationCommunicator, WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 import pycrdt
+from pycrdt_model.consumers import (
+    SaverWorker,
+    YjsSaverWorkerConsumer,
+    _DebounceScheduler,
+    _PendingState,
+    _RoomDocRegistry,
+    jump_consistent_hash,
+    worker_channel_for,
+    worker_channel_names,
+)
+from pycrdt_model import compression, metrics
+from pycrdt_model.models import History, HistorySnapshot, YDocUpdate
+from pycrdt_model.pending_buffer import RedisPendingBuffer
+from pycrdt_model.profiling import LoggingSpanExporter
+from pycrdt_model.signals import pending_post_apply, pending_post_save, pending_pre_load
+from .consumers import TestDocUpdateConsumer
 from .models import TestDoc
+from . import views
+from .tiptap_to_html import TiptapToHtml
+from .views import observe_history
 
 class TestDocTestCase(TestCase):
     def setUp(self):
@@ -38,6 +72,29 @@ class TestDocTestCase(TestCase):
         self.assertEqual(obj3.name, "Test Doc")
         self.assertEqual(obj3.stored_name, "Test Doc")
 
+    def test_doc_decoded_lazily(self):
+        self.obj.name = "Test Doc"
+        self.obj.save()
+
+        obj2 = TestDoc.objects.get(pk=self.obj.pk)
+        self.assertFalse(obj2.yjs_doc_loaded)
+        self.assertEqual(str(obj2), "Test Doc")
+        obj2.stored_score = 5
+        obj2.save()
+        self.assertFalse(obj2.yjs_doc_loaded)
+
+        self.assertEqual(obj2.name, "Test Doc")
+        self.assertTrue(obj2.yjs_doc_loaded)
+        self.assertEqual(History.for_object(obj2).count(), 1)
+
+        deferred = TestDoc.objects.defer("yjs_doc").get(pk=self.obj.pk)
+        self.assertFalse(deferred.yjs_doc_loaded)
+        deferred.stored_score = 6
+        with CaptureQueriesContext(connection) as queries:
+            deferred.save()
+        self.assertNotIn("yjs_doc", queries.captured_queries[-1]["sql"])
+        self.assertFalse(deferred.yjs_doc_loaded)
+
     def test_title_update_through_doc(self):
         self.obj.yjs_doc.get("non_collab_fields", type=pycrdt.Map)["name"] = "Test Doc"
 
@@ -56,3 +113,1071 @@ class TestDocTestCase(TestCase):
         self.assertEqual(str(obj3.yjs_doc.get("non_collab_fields", type=pycrdt.Map)["name"]), "Test Doc")
         self.assertEqual(obj3.name, "Test Doc")
         self.assertEqual(obj3.stored_name, "Test Doc")
+
+
+class HistoryReplayTestCase(TestCase):
+    def setUp(self):
+        self.obj = TestDoc.objects.create()
+
+    @mock.patch.object(TestDoc, "history_snapshot_every_entries", 3)
+    def test_replay_from_snapshots(self):
+        for i in range(7):
+            self.obj.description.children.append(f"line {i} ")
+            self.obj.save()
+
+        entries = list(History.for_object(self.obj))
+        self.assertEqual(len(entries), 7)
+        self.assertEqual(
+            list(History.objects.for_ids(TestDoc.yjs_content_type_id(), self.obj.pk).order_by("id")),
+            entries,
+        )
+        self.assertEqual(HistorySnapshot.for_object(self.obj).count(), 2)
+
+        for i, entry in enumerate(entries):
+            doc = History.replay(self.obj, entry.id)
+            self.assertEqual(
+                str(doc.get("description", type=pycrdt.XmlFragment)),
+                "".join(f"line {j} " for j in range(i + 1)),
+            )
+
+        replayed = [
+            (entry, str(doc.get("description", type=pycrdt.XmlFragment)), len(events["description"]))
+            for entry, doc, events in History.replay_range(
+                self.obj, entries[4].id, entries[5].id, {"description": pycrdt.XmlFragment}
+            )
+        ]
+        self.assertEqual(
+            replayed,
+            [
+                (None, "line 0 line 1 line 2 line 3 ", 0),
+                (entries[4], "line 0 line 1 line 2 line 3 line 4 ", 1),
+                (entries[5], "line 0 line 1 line 2 line 3 line 4 line 5 ", 1),
+            ],
+        )
+        # A range with no entries still gets the state at its start
+        ((entry, doc, events),) = History.replay_range(
+            self.obj, entries[-1].id + 1, entries[-1].id + 5, {"description": pycrdt.XmlFragment}
+        )
+        self.assertIsNone(entry)
+        self.assertEqual(
+            str(doc.get("description", type=pycrdt.XmlFragment)),
+            "".join(f"line {j} " for j in range(7)),
+        )
+        self.assertEqual(events, {"description": []})
+
+        doc, entry = History.replay_until(self.obj, entries[3].id)
+        self.assertEqual(entry, entries[3])
+        self.assertEqual(
+            str(doc.get("description", type=pycrdt.XmlFragment)),
+            "line 0 line 1 line 2 ",
+        )
+
+    def test_page_for_object(self):
+        for i in range(7):
+            self.obj.description.children.append(f"line {i} ")
+            self.obj.save()
+        ids = list(History.for_object(self.obj, recent_first=True).values_list("id", flat=True))
+
+        page = History.page_for_object(self.obj, 3)
+        self.assertEqual(([e.id for e in page.entries], page.has_newer, page.has_older), (ids[0:3], False, True))
+        page = History.page_for_object(self.obj, 3, before=page.entries[-1].id)
+        self.assertEqual(([e.id for e in page.entries], page.has_newer, page.has_older), (ids[3:6], True, True))
+        page = History.page_for_object(self.obj, 3, before=page.entries[-1].id)
+        self.assertEqual(([e.id for e in page.entries], page.has_newer, page.has_older), (ids[6:], True, False))
+        page = History.page_for_object(self.obj, 3, after=page.entries[0].id)
+        self.assertEqual(([e.id for e in page.entries], page.has_newer, page.has_older), (ids[3:6], True, True))
+        page = History.page_for_object(self.obj, 3, after=ids[2])
+        self.assertEqual(([e.id for e in page.entries], page.has_newer, page.has_older), (ids[0:2], False, True))
+
+        self.client.force_login(User.objects.create_user("reader"))
+        response = self.client.get(f"/{self.obj.pk}/history?before={ids[2]}")
+        self.assertEqual([entry.id for entry in response.context["page"].entries], ids[3:])
+        self.assertContains(response, f"?after={ids[3]}")
+
+    @mock.patch.object(TestDoc, "history_snapshot_every_entries", 2)
+    def test_squash(self):
+        alice = User.objects.create_user("alice")
+        bob = User.objects.create_user("bob")
+        for i, author in enumerate([alice, alice, alice, bob, bob, alice, alice]):
+            self.obj.description.children.append(f"line {i} ")
+            self.obj.save(user=author)
+        old = timezone.now() - timedelta(days=60)
+        History.for_object(self.obj).update(time=old)
+        # One more recent entry, which is left alone
+        self.obj.description.children.append("line 7 ")
+        self.obj.save(user=alice)
+
+        removed = History.squash(
+            ContentType.objects.get_for_model(self.obj),
+            self.obj.pk,
+            timezone.now() - timedelta(days=30),
+            timedelta(hours=1),
+            batch_size=2,
+        )
+        self.assertEqual(removed, 4)
+
+        entries = list(History.for_object(self.obj))
+        self.assertEqual(
+            [entry.author for entry in entries], [alice, bob, alice, alice]
+        )
+        for entry, lines in zip(entries, [3, 5, 7, 8]):
+            self.assertEqual(
+                str(History.replay(self.obj, entry.id).get("description", type=pycrdt.XmlFragment)),
+                "".join(f"line {j} " for j in range(lines)),
+            )
+        # Snapshots at removed entries are gone, the rest are still at their entries
+        self.assertEqual(
+            list(HistorySnapshot.for_object(self.obj).values_list("history_id", flat=True)),
+            [entries[3].id],
+        )
+
+    def test_squash_rejects_empty_interval(self):
+        with self.assertRaises(ValueError):
+            History.squash(
+                ContentType.objects.get_for_model(self.obj), self.obj.pk, timezone.now(), timedelta(0)
+            )
+        with self.assertRaises(CommandError):
+            call_command("squash_history", interval_minutes=0, stdout=StringIO())
+
+
+class HistoryDiffCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.obj = TestDoc.objects.create()
+        self.user = User.objects.create_user("alice")
+        for i in range(3):
+            self.obj.description.children.append(f"line {i} ")
+            self.obj.save(user=self.user)
+        self.client.force_login(self.user)
+
+    def get_history(self, render):
+        with mock.patch.object(views, "render_history_diffs", wraps=render) as rendered:
+            response = self.client.get(f"/{self.obj.pk}/history")
+        self.assertEqual(response.status_code, 200)
+        return rendered, response.content.decode()
+
+    def test_cache_hit(self):
+        rendered, first = self.get_history(views.render_history_diffs)
+        rendered.assert_called_once()
+        rendered, second = self.get_history(views.render_history_diffs)
+        rendered.assert_not_called()
+        self.assertEqual(first, second)
+
+    def test_history_view_cached(self):
+        entries = list(History.for_object(self.obj))
+        url = f"/{self.obj.pk}/history/{entries[1].id}"
+        with mock.patch.object(views, "render_history_view", wraps=views.render_history_view) as rendered:
+            first = self.client.get(url)
+            second = self.client.get(url)
+        rendered.assert_called_once()
+        self.assertEqual(first.status_code, 200)
+        self.assertContains(first, '<span class="changeset-added">line 1 </span>', html=False)
+        self.assertEqual(first.content, second.content)
+
+        # The list renders the other entries, reusing the view's diff
+        rendered, _ = self.get_history(views.render_history_diffs)
+        self.assertEqual(rendered.call_args.args[3], {entries[0].id, entries[2].id})
+
+        self.assertEqual(self.client.get(f"/{self.obj.pk}/history/{entries[-1].id + 1}").status_code, 404)
+
+    def test_squashed_while_rendering(self):
+        # As if the entries were squashed away between loading the page and replaying it
+        rendered, content = self.get_history(lambda *args: {})
+        rendered.assert_called_once()
+        self.assertNotIn("changeset-added", content)
+
+    def test_squash_invalidates(self):
+        self.get_history(views.render_history_diffs)
+        History.for_object(self.obj).update(time=timezone.now() - timedelta(days=60))
+        History.squash(
+            ContentType.objects.get_for_model(self.obj),
+            self.obj.pk,
+            timezone.now() - timedelta(days=30),
+            timedelta(hours=1),
+        )
+        (entry,) = History.for_object(self.obj)
+
+        rendered, content = self.get_history(views.render_history_diffs)
+        rendered.assert_called_once()
+        self.assertEqual(rendered.call_args.args[3], {entry.id})
+        # The squashed entry now shows every line as added
+        self.assertEqual(
+            cache.get(views.history_diff_cache_key(entry.id, "description")).count("changeset-added"), 3
+        )
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+class TestDocConsumerTestCase(TransactionTestCase):
+    async def connect(
+        self, user: User, obj: TestDoc, consumer: type[TestDocUpdateConsumer] = TestDocUpdateConsumer
+    ) -> WebsocketCommunicator:
+        communicator = WebsocketCommunicator(
+            consumer.as_asgi(worker_channel_name="yjs-save-test"),
+            f"/ws/doc/{obj.pk}",
+        )
+        communicator.scope["user"] = user
+        communicator.scope["url_route"] = {"kwargs": {"pk": obj.pk}}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        # Initial sync step 1
+        await communicator.receive_from()
+        return communicator
+
+    async def test_room_doc_shared(self):
+        user = await User.objects.acreate(username="user")
+        obj = await TestDoc.objects.acreate()
+        room_docs = TestDocUpdateConsumer.room_docs.rooms
+
+        first = await self.connect(user, obj)
+        second = await self.connect(user, obj)
+        self.assertEqual(len(room_docs), 1)
+        (room,) = room_docs.values()
+        self.assertEqual(room.refcount, 2)
+
+        client = pycrdt.Doc()
+        client.get("description", type=pycrdt.XmlFragment).children.append("hello")
+        await first.send_to(
+            bytes_data=pycrdt.create_update_message(client.get_update())
+        )
+        message = await get_channel_layer().receive("yjs-save-test")
+        self.assertEqual(message["type"], "doc_updated")
+        self.assertEqual(message["user_pk"], user.pk)
+        self.assertEqual(
+            str(room.ydoc.get("description", type=pycrdt.XmlFragment)), "hello"
+        )
+
+        await first.disconnect()
+        self.assertEqual(room.refcount, 1)
+        await second.disconnect()
+        self.assertEqual(room_docs, {})
+
+    async def test_room_doc_from_other_process(self):
+        class OtherProcessConsumer(TestDocUpdateConsumer):
+            room_docs = _RoomDocRegistry()
+
+        user = await User.objects.acreate(username="user")
+        obj = await TestDoc.objects.acreate()
+        first = await self.connect(user, obj)
+        client = pycrdt.Doc()
+        text = client.get("description", type=pycrdt.XmlFragment)
+        text.children.append("unsaved")
+        await first.send_to(bytes_data=pycrdt.create_update_message(client.get_update()))
+        await first.receive_from()
+
+        # Not saved yet, so only the first process' doc has the edit, which it sends on request
+        second = await self.connect(user, obj, OtherProcessConsumer)
+        (room,) = OtherProcessConsumer.room_docs.rooms.values()
+        description = room.ydoc.get("description", type=pycrdt.XmlFragment)
+        self.assertEqual(str(description), "")
+        self.assertEqual(
+            (await second.receive_from())[:2],
+            bytes([pycrdt.YMessageType.SYNC, pycrdt.YSyncMessageType.SYNC_UPDATE]),
+        )
+        self.assertEqual(str(description), "unsaved")
+
+        # Leaders apply edits from other processes
+        state = client.get_state()
+        text.children.append(" edit")
+        await first.send_to(bytes_data=pycrdt.create_update_message(client.get_update(state)))
+        await second.receive_from()
+        self.assertEqual(str(room.ydoc.get("description", type=pycrdt.XmlFragment)), "unsaved edit")
+
+        await first.disconnect()
+        await second.disconnect()
+        # Drop the messages sent to the worker, which isn't running
+        await get_channel_layer().flush()
+
+    async def test_worker_updates_merged(self):
+        class MergingConsumer(TestDocUpdateConsumer):
+            merge_worker_updates = True
+
+        layer = get_channel_layer()
+        await layer.flush()
+        layer_send = layer.send
+
+        async def slow_send(channel, message):
+            if channel == "yjs-save-test":
+                await asyncio.sleep(0.05)
+            await layer_send(channel, message)
+
+        user = await User.objects.acreate(username="user")
+        obj = await TestDoc.objects.acreate()
+        client = pycrdt.Doc()
+        text = client.get("description", type=pycrdt.XmlFragment)
+        with mock.patch.object(layer, "send", slow_send):
+            communicator = await self.connect(user, obj, MergingConsumer)
+            for i in range(20):
+                state = client.get_state()
+                text.children.append(f"{i} ")
+                await communicator.send_to(
+                    bytes_data=pycrdt.create_update_message(client.get_update(state))
+                )
+            await communicator.disconnect()
+
+        updates = []
+        while (message := await layer.receive("yjs-save-test"))["type"] == "doc_updated":
+            updates.append(message["update_bytes"])
+        self.assertEqual(message["type"], "doc_flush")
+        self.assertLess(len(updates), 20)
+        saved = pycrdt.Doc()
+        description = saved.get("description", type=pycrdt.XmlFragment)
+        for update in updates:
+            saved.apply_update(update)
+        self.assertEqual(str(description), str(text))
+
+    async def test_worker_send_failure_closes(self):
+        class MergingConsumer(TestDocUpdateConsumer):
+            merge_worker_updates = True
+
+        layer = get_channel_layer()
+        await layer.flush()
+        layer_send = layer.send
+        failures = [RuntimeError("layer down")]
+
+        async def failing_send(channel, message):
+            if channel == "yjs-save-test" and failures:
+                raise failures.pop()
+            await layer_send(channel, message)
+
+        user = await User.objects.acreate(username="user")
+        obj = await TestDoc.objects.acreate()
+        client = pycrdt.Doc()
+        client.get("description", type=pycrdt.XmlFragment).children.append("lost")
+        with mock.patch.object(layer, "send", failing_send), self.assertLogs(
+            "pycrdt_model.consumers", "ERROR"
+        ):
+            communicator = await self.connect(user, obj, MergingConsumer)
+            await communicator.send_to(bytes_data=pycrdt.create_update_message(client.get_update()))
+            while (await communicator.receive_output())["type"] != "websocket.close":
+                pass
+            await communicator.disconnect()
+
+        # Still flushed and left the room
+        self.assertEqual((await layer.receive("yjs-save-test"))["type"], "doc_flush")
+        self.assertFalse(layer.groups.get(f"yjs-{TestDoc._meta.label}-{obj.pk}"))
+
+    async def test_incremental_storage_loaded(self):
+        @database_sync_to_async
+        def create_with_update() -> TestDoc:
+            obj = TestDoc.objects.create()
+            obj = TestDoc.objects.get(pk=obj.pk)
+            obj.description.children.append("logged")
+            obj.save()
+            return obj
+
+        user = await User.objects.acreate(username="user")
+        with mock.patch.object(TestDoc, "yjs_incremental_storage", True):
+            obj = await create_with_update()
+            self.assertEqual(await YDocUpdate.for_object(obj).acount(), 1)
+            communicator = await self.connect(user, obj)
+        (room,) = TestDocUpdateConsumer.room_docs.rooms.values()
+        self.assertEqual(str(room.ydoc.get("description", type=pycrdt.XmlFragment)), "logged")
+        await communicator.disconnect()
+        await get_channel_layer().flush()
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+class SaverWorkerTestCase(TransactionTestCase):
+    async def test_flushes_batched(self):
+        objs = [await TestDoc.objects.acreate() for _ in range(3)]
+        worker = ApplicationCommunicator(
+            YjsSaverWorkerConsumer.as_asgi(), {"type": "channel", "channel": "yjs-save-test"}
+        )
+        for i, obj in enumerate(objs):
+            client = pycrdt.Doc()
+            client.get("description", type=pycrdt.XmlFragment).children.append(f"doc {i}")
+            message = {
+                "connection_id": f"connection-{i}",
+                "model_app": "collab_poc_app",
+                "model_name": "testdoc",
+                # As sent by the websocket consumer, from the URL
+                "model_pk": str(obj.pk),
+                "user_pk": None,
+            }
+            await worker.send_input({"type": "doc_updated", "update_bytes": client.get_update(), **message})
+            await worker.send_input({"type": "doc_flush", **message})
+
+        with mock.patch.object(
+            _PendingState, "save_many", wraps=_PendingState.save_many
+        ) as save_many:
+            await asyncio.sleep(YjsSaverWorkerConsumer.batch_flush_window + 0.2)
+        save_many.assert_called_once()
+        for i, obj in enumerate(objs):
+            obj = await TestDoc.objects.aget(pk=obj.pk)
+            self.assertEqual(str(obj.description), f"doc {i}")
+            self.assertEqual(await History.for_object(obj).acount(), 1)
+        worker.stop()
+
+    @mock.patch.object(YjsSaverWorkerConsumer, "coalesce_by_document", True)
+    async def test_coalesced_by_document(self):
+        obj = await TestDoc.objects.acreate()
+        users = [await User.objects.acreate(username=f"user-{i}") for i in range(2)]
+        worker = ApplicationCommunicator(
+            YjsSaverWorkerConsumer.as_asgi(), {"type": "channel", "channel": "yjs-save-test"}
+        )
+        client = pycrdt.Doc()
+        text = client.get("description", type=pycrdt.XmlFragment)
+        # Two connections per user, all editing the same doc
+        for i, word in enumerate(["one ", "two ", "three ", "four"]):
+            state = client.get_state()
+            text.children.append(word)
+            await worker.send_input(
+                {
+                    "type": "doc_updated",
+                    "connection_id": f"connection-{i}",
+                    "model_app": "collab_poc_app",
+                    "model_name": "testdoc",
+                    "model_pk": str(obj.pk),
+                    "user_pk": users[i % 2].pk,
+                    "update_bytes": client.get_update(state),
+                }
+            )
+
+        with mock.patch.object(
+            _PendingState, "save_many", wraps=_PendingState.save_many
+        ) as save_many:
+            await asyncio.sleep(_PendingState.save_debounce_time + 0.3)
+        save_many.assert_called_once()
+        (states,) = save_many.call_args.args
+        self.assertEqual(len(states), 1)
+        obj = await TestDoc.objects.aget(pk=obj.pk)
+        self.assertEqual(str(obj.description), "one two three four")
+        # One entry per author
+        self.assertEqual(
+            {entry.author_id async for entry in History.for_object(obj)}, {user.pk for user in users}
+        )
+        self.assertEqual(await History.for_object(obj).acount(), 2)
+        worker.stop()
+
+    async def test_pending_buffer_recovered(self):
+        obj = await TestDoc.objects.acreate()
+        buffer = RedisPendingBuffer(FakeRedis())
+        scope = {"type": "channel", "channel": "yjs-save-test"}
+        message = {
+            "connection_id": "connection",
+            "model_app": "collab_poc_app",
+            "model_name": "testdoc",
+            "model_pk": str(obj.pk),
+            "user_pk": None,
+        }
+        client = pycrdt.Doc()
+        text = client.get("description", type=pycrdt.XmlFragment)
+        worker = ApplicationCommunicator(YjsSaverWorkerConsumer.as_asgi(pending_buffer=buffer), scope)
+        for word in ["buffered ", "updates"]:
+            state = client.get_state()
+            text.children.append(word)
+            await worker.send_input({"type": "doc_updated", "update_bytes": client.get_update(state), **message})
+        await asyncio.sleep(0.05)
+        # Stops before the debounce time is up
+        worker.stop()
+        self.assertEqual(len((await buffer.recover("yjs-save-test"))[0].updates), 2)
+
+        # Saved on startup, without waiting for a message
+        saver = SaverWorker(
+            YjsSaverWorkerConsumer.as_asgi(pending_buffer=buffer), ["yjs-save-test"], get_channel_layer()
+        )
+        task = asyncio.create_task(saver.handle())
+        await asyncio.sleep(YjsSaverWorkerConsumer.batch_flush_window + 0.2)
+        task.cancel()
+        for instance in saver.application_instances.values():
+            instance["future"].cancel()
+        obj = await TestDoc.objects.aget(pk=obj.pk)
+        self.assertEqual(str(obj.description), "buffered updates")
+        self.assertEqual(await buffer.recover("yjs-save-test"), [])
+        self.assertEqual(buffer.client.data, {})
+
+    async def test_pending_buffer_partial_trim(self):
+        buffer = RedisPendingBuffer(FakeRedis())
+        await buffer.append("channel", "key", 1, b"first", model_label="app.Model", doc_pk=5)
+        await buffer.append("channel", "key", None, b"second")
+        await buffer.trim("channel", "key", 1)
+        (state,) = await buffer.recover("channel")
+        self.assertEqual(state, ("key", "app.Model", "5", [(None, b"second")]))
+        await buffer.trim("channel", "key", 1)
+        self.assertEqual(buffer.client.data, {})
+
+    async def test_failed_state_kept_in_batch(self):
+        objs = [await TestDoc.objects.acreate() for _ in range(2)]
+        buffer = RedisPendingBuffer(FakeRedis())
+        worker = ApplicationCommunicator(
+            YjsSaverWorkerConsumer.as_asgi(pending_buffer=buffer),
+            {"type": "channel", "channel": "yjs-save-test"},
+        )
+        clients = [pycrdt.Doc() for _ in objs]
+        messages = [
+            {
+                "connection_id": f"connection-{i}",
+                "model_app": "collab_poc_app",
+                "model_name": "testdoc",
+                "model_pk": str(obj.pk),
+                "user_pk": None,
+            }
+            for i, obj in enumerate(objs)
+        ]
+
+        async def edit(i, word):
+            state = clients[i].get_state()
+            clients[i].get("description", type=pycrdt.XmlFragment).children.append(word)
+            await worker.send_input(
+                {"type": "doc_updated", "update_bytes": clients[i].get_update(state), **messages[i]}
+            )
+
+        for word in ["one ", "two ", "three "]:
+            await edit(0, word)
+        await edit(1, "other")
+        save_many = _PendingState.save_many
+
+        def fail_first_doc(states):
+            if any(state.doc_pk == messages[0]["model_pk"] for state in states):
+                raise OperationalError("connection lost")
+            return save_many(states)
+
+        with mock.patch.object(
+            _PendingState, "save_many", side_effect=fail_first_doc
+        ), self.assertLogs("pycrdt_model.consumers", "ERROR"):
+            for message in messages:
+                await worker.send_input({"type": "doc_flush", **message})
+            await asyncio.sleep(YjsSaverWorkerConsumer.batch_flush_window + 0.2)
+        self.assertEqual(str((await TestDoc.objects.aget(pk=objs[1].pk)).description), "other")
+        self.assertEqual(str((await TestDoc.objects.aget(pk=objs[0].pk)).description), "")
+
+        # Saved along with the updates that failed, which are only then dropped from the buffer
+        await edit(0, "four")
+        await worker.send_input({"type": "doc_flush", **messages[0]})
+        await asyncio.sleep(YjsSaverWorkerConsumer.batch_flush_window + 0.2)
+        obj = await TestDoc.objects.aget(pk=objs[0].pk)
+        self.assertEqual(str(obj.description), "one two three four")
+        self.assertEqual(buffer.client.data, {})
+        worker.stop()
+
+    @mock.patch.object(YjsSaverWorkerConsumer, "save_retry_delay", 0.1)
+    async def test_failed_save_retried(self):
+        obj = await TestDoc.objects.acreate()
+        deleted = await TestDoc.objects.acreate()
+        worker = ApplicationCommunicator(
+            YjsSaverWorkerConsumer.as_asgi(), {"type": "channel", "channel": "yjs-save-test"}
+        )
+        for i, doc in enumerate([obj, deleted]):
+            client = pycrdt.Doc()
+            client.get("description", type=pycrdt.XmlFragment).children.append("retried")
+            await worker.send_input(
+                {
+                    "type": "doc_updated",
+                    "connection_id": f"connection-{i}",
+                    "model_app": "collab_poc_app",
+                    "model_name": "testdoc",
+                    "model_pk": str(doc.pk),
+                    "user_pk": None,
+                    "update_bytes": client.get_update(),
+                }
+            )
+        await deleted.adelete()
+        failures = [OperationalError("connection lost")]
+        save_many = _PendingState.save_many
+
+        def fail_once(states):
+            if failures and states[0].key == "connection-0":
+                raise failures.pop()
+            return save_many(states)
+
+        with mock.patch.object(
+            _PendingState, "save_many", side_effect=fail_once
+        ) as saves, self.assertLogs("pycrdt_model.consumers", "ERROR") as logs:
+            for i in range(2):
+                await worker.send_input({"type": "doc_flush", "pending_key": f"connection-{i}"})
+                # Each saved on its own
+                await asyncio.sleep(YjsSaverWorkerConsumer.batch_flush_window + 0.05)
+            self.assertEqual(str((await TestDoc.objects.aget(pk=obj.pk)).description), "")
+            # Retried without another update or flush
+            await asyncio.sleep(YjsSaverWorkerConsumer.save_retry_delay + 0.2)
+        self.assertEqual(str((await TestDoc.objects.aget(pk=obj.pk)).description), "retried")
+        # The deleted document's state was dropped rather than retried
+        self.assertEqual(saves.call_count, 3)
+        self.assertEqual(len(logs.records), 2)
+        worker.stop()
+
+
+class FakeRedis:
+    """
+    The subset of `redis.asyncio.Redis` used by `RedisPendingBuffer`, in memory.
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def hset(self, name, mapping):
+        self.data.setdefault(name, {}).update(
+            {key.encode(): str(value).encode() for key, value in mapping.items()}
+        )
+
+    async def hgetall(self, name):
+        return dict(self.data.get(name, {}))
+
+    async def sadd(self, name, value):
+        self.data.setdefault(name, set()).add(value.encode())
+
+    async def srem(self, name, value):
+        self.data.get(name, set()).discard(value.encode())
+        if not self.data.get(name, True):
+            del self.data[name]
+
+    async def smembers(self, name):
+        return set(self.data.get(name, set()))
+
+    async def rpush(self, name, value):
+        self.data.setdefault(name, []).append(value)
+
+    async def lrange(self, name, start, end):
+        return list(self.data.get(name, []))[start : None if end == -1 else end + 1]
+
+    async def ltrim(self, name, start, end):
+        if name in self.data:
+            self.data[name] = self.data[name][start : None if end == -1 else end + 1]
+            # Redis deletes empty lists
+            if not self.data[name]:
+                del self.data[name]
+
+    async def llen(self, name):
+        return len(self.data.get(name, []))
+
+    async def delete(self, *names):
+        for name in names:
+            self.data.pop(name, None)
+
+
+class FakePipeline:
+    """
+    Queues `FakeRedis` commands until `execute`.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+
+        return queue
+
+    async def execute(self):
+        results = [
+            await getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.commands
+        ]
+        self.commands = []
+        return results
+
+
+class DebounceSchedulerTestCase(SimpleTestCase):
+    async def test_debounce_and_max_wait(self):
+        fired = []
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+
+        async def callback(key):
+            fired.append((key, loop.time() - start))
+
+        scheduler = _DebounceScheduler(callback)
+        scheduler.trigger("quiet", 0.05)
+        # Keeps triggering more often than the delay, so only the max wait gets it to fire
+        while loop.time() - start < 0.2:
+            scheduler.trigger("busy", 0.05, max_wait=0.1)
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+
+        self.assertEqual(fired[0][0], "quiet")
+        self.assertEqual(fired[1][0], "busy")
+        self.assertAlmostEqual(fired[1][1], 0.1, delta=0.04)
+
+        count = len(fired)
+        scheduler.trigger("cancelled", 0.01)
+        scheduler.cancel("cancelled")
+        await asyncio.sleep(0.03)
+        self.assertEqual(len(fired), count)
+        scheduler.stop()
+
+
+class WorkerShardingTestCase(SimpleTestCase):
+    def test_jump_consistent_hash(self):
+        before = [jump_consistent_hash(key * 0x9E3779B97F4A7C15 % 2**64, 4) for key in range(1000)]
+        after = [jump_consistent_hash(key * 0x9E3779B97F4A7C15 % 2**64, 5) for key in range(1000)]
+        self.assertEqual(set(before), {0, 1, 2, 3})
+        # Keys only ever move to the new bucket
+        moved = [(old, new) for old, new in zip(before, after) if old != new]
+        self.assertTrue(all(new == 4 for _, new in moved))
+        self.assertLess(len(moved), 300)
+
+    def test_worker_channel_for(self):
+        self.assertEqual(worker_channel_for(TestDoc, 1, "yjs-save"), "yjs-save")
+        names = worker_channel_names("yjs-save", 3)
+        self.assertEqual(names, ["yjs-save-0", "yjs-save-1", "yjs-save-2"])
+        picked = {worker_channel_for(TestDoc, pk, "yjs-save", 3) for pk in range(100)}
+        self.assertEqual(picked, set(names))
+        self.assertEqual(
+            worker_channel_for(TestDoc, 42, "yjs-save", 3),
+            worker_channel_for(TestDoc, 42, "yjs-save", 3),
+        )
+
+
+class PendingStateTestCase(TestCase):
+    def test_save_attributes_authors(self):
+        obj = TestDoc.objects.create()
+        alice = User.objects.create(username="alice")
+        bob = User.objects.create(username="bob")
+
+        state = _PendingState(f"doc-{obj.pk}", TestDoc, obj.pk, None, "")
+        client = pycrdt.Doc()
+        description = client.get("description", type=pycrdt.XmlFragment)
+        for user, text in [(alice, "hello "), (bob, "world"), (alice, "!")]:
+            before = client.get_state()
+            description.children.append(text)
+            update = client.get_update(before)
+            if user.pk in state.updates:
+                update = pycrdt.merge_updates(state.updates[user.pk], update)
+            state.updates[user.pk] = update
+        state.save()
+
+        obj.refresh_from_db()
+        self.assertEqual(str(obj.description), "hello world!")
+        self.assertEqual(
+            [entry.author for entry in History.for_object(obj)], [alice, bob]
+        )
+
+    def test_save_many(self):
+        first = TestDoc.objects.create()
+        second = TestDoc.objects.create()
+        alice = User.objects.create(username="alice")
+        bob = User.objects.create(username="bob")
+
+        def state(obj, user, text):
+            state = _PendingState(f"state-{obj.pk}-{user.pk}", TestDoc, obj.pk, None, "")
+            client = pycrdt.Doc()
+            client.get("description", type=pycrdt.XmlFragment).children.append(text)
+            state.updates[user.pk] = client.get_update()
+            return state
+
+        instances = _PendingState.save_many(
+            [state(first, alice, "one"), state(second, alice, "two"), state(first, bob, "three")]
+        )
+        self.assertIs(instances[0], instances[2])
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(len(str(first.description)), len("onethree"))
+        self.assertEqual(str(second.description), "two")
+        self.assertEqual(
+            [entry.author for entry in History.for_object(first)], [alice, bob]
+        )
+        self.assertEqual(
+            [entry.author for entry in History.for_object(second)], [alice]
+        )
+
+    async def test_pending_state_merges_and_forces_flush(self):
+        fired = asyncio.Event()
+
+        async def callback(key):
+            fired.set()
+
+        state = _PendingState("key", TestDoc, 1, None, "", _DebounceScheduler(callback))
+        state.max_pending_bytes = 200
+        client = pycrdt.Doc()
+        text = client.get("description", type=pycrdt.XmlFragment)
+        for _ in range(3):
+            before = client.get_state()
+            text.children.append("x")
+            state.update(client.get_update(before), 1)
+        self.assertEqual(list(state.updates), [1])
+        merged = pycrdt.Doc()
+        merged.apply_update(state.updates[1])
+        self.assertEqual(str(merged.get("description", type=pycrdt.XmlFragment)), "xxx")
+        self.assertFalse(fired.is_set())
+
+        before = client.get_state()
+        text.children.append("y" * 200)
+        state.update(client.get_update(before), 2)
+        # Well before the debounce time
+        await asyncio.wait_for(fired.wait(), 0.5)
+        state.scheduler.stop()
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+        metrics.set_sink(self.registry)
+        self.addCleanup(metrics.set_sink, None)
+
+    def test_render(self):
+        metrics.increment("requests_total", labels={"path": 'a"b'})
+        metrics.increment("requests_total", 2, labels={"path": 'a"b'})
+        metrics.set_gauge("sockets", 3, {"room": "x"})
+        metrics.set_gauge("sockets", 1, {"room": "y"})
+        metrics.set_gauge("sockets", None, {"room": "y"})
+        metrics.observe("latency_seconds", 0.003)
+        metrics.observe("latency_seconds", 20)
+        text = self.registry.render()
+        self.assertIn('requests_total{path="a\\"b"} 3\n', text)
+        self.assertIn('sockets{room="x"} 3\n', text)
+        self.assertNotIn('room="y"', text)
+        self.assertIn('latency_seconds_bucket{le="0.0025"} 0\n', text)
+        self.assertIn('latency_seconds_bucket{le="0.005"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn("latency_seconds_count 2\n", text)
+
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 302)
+        self.client.force_login(User.objects.create_user("metrics", is_staff=True))
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.decode(), self.registry.render())
+
+    def test_save_phases(self):
+        obj = TestDoc.objects.create()
+        state = _PendingState(f"doc-{obj.pk}", TestDoc, obj.pk, None, "")
+        client = pycrdt.Doc()
+        client.get("description", type=pycrdt.XmlFragment).children.append("hello")
+        state.updates[None] = client.get_update()
+        state.save()
+        self.assertEqual(
+            {key: histogram.count for key, histogram in self.registry.histograms["yjs_save_seconds"].items()},
+            {(("phase", phase),): 1 for phase in ["lock", "load", "apply", "save"]},
+        )
+
+
+class ProfilingHooksTestCase(TestCase):
+    def test_hooks_and_spans(self):
+        obj = TestDoc.objects.create()
+        state = _PendingState(f"doc-{obj.pk}", TestDoc, obj.pk, None, "")
+        client = pycrdt.Doc()
+        client.get("description", type=pycrdt.XmlFragment).children.append("hello")
+        state.updates[None] = client.get_update()
+
+        calls = []
+
+        def hook(signal, **kwargs):
+            calls.append((kwargs["update_bytes"], list(kwargs.get("timings", {}))))
+
+        for signal in [pending_pre_load, pending_post_apply, pending_post_save]:
+            signal.connect(hook, weak=False)
+            self.addCleanup(signal.disconnect, hook)
+        exporter = LoggingSpanExporter()
+        exporter.connect()
+        self.addCleanup(exporter.disconnect)
+
+        with CaptureQueriesContext(connection) as queries, self.assertLogs(
+            "pycrdt_model.spans"
+        ) as logs:
+            state.save()
+
+        size = len(state.updates[None])
+        self.assertEqual(
+            calls,
+            [
+                (size, []),
+                (size, ["lock", "load", "apply"]),
+                (size, ["lock", "load", "apply", "save"]),
+            ],
+        )
+        # Debug logging doesn't look up the authors
+        self.assertFalse(any("auth_user" in query["sql"] for query in queries))
+
+        spans = [json.loads(record.getMessage()) for record in logs.records]
+        self.assertEqual(
+            [span["name"] for span in spans],
+            ["pycrdt_model.save"] + [f"pycrdt_model.save.{phase}" for phase in ["lock", "load", "apply", "save"]],
+        )
+        self.assertEqual(spans[0]["attributes"]["update_bytes"], size)
+        for span in spans[1:]:
+            self.assertEqual(span["parent_span_id"], spans[0]["span_id"])
+            self.assertEqual(span["trace_id"], spans[0]["trace_id"])
+        self.assertEqual(spans[-1]["end_time_unix_nano"], spans[0]["end_time_unix_nano"])
+
+
+class GenerateHistoryTestCase(TestCase):
+    def test_deterministic(self):
+        authors, contents = [], []
+        for _ in range(2):
+            call_command("generate_history", entries=150, authors=2, seed=1, stdout=StringIO())
+            obj = TestDoc.objects.latest("pk")
+            authors.append(list(History.for_object(obj).values_list("author__username", flat=True)))
+            contents.append(str(obj.contents))
+            self.assertEqual(obj.stored_name, "Synthetic 1-0")
+        self.assertEqual(len(authors[0]), 150)
+        self.assertEqual(set(authors[0]), {"synthetic-author-0", "synthetic-author-1"})
+        self.assertEqual(authors[0], authors[1])
+        self.assertEqual(contents[0], contents[1])
+        # Saved in chunks, with snapshots as usual
+        self.assertEqual(HistorySnapshot.for_object(obj).count(), 1)
+        last = History.for_object(obj, recent_first=True).first()
+        replayed = History.replay(obj, last.id).get("contents", type=pycrdt.XmlFragment)
+        self.assertEqual(str(replayed), contents[0])
+
+
+@mock.patch.object(TestDoc, "yjs_incremental_storage", True)
+@mock.patch.object(TestDoc, "yjs_compact_after_updates", 3)
+class IncrementalStorageTestCase(TestCase):
+    def test_updates_appended_and_compacted(self):
+        obj = TestDoc.objects.create()
+        for i in range(3):
+            obj = TestDoc.objects.get(pk=obj.pk)
+            self.assertFalse(obj.yjs_compaction_due)
+            obj.description.children.append(f"line {i} ")
+            obj.save()
+
+        self.assertEqual(YDocUpdate.for_object(obj).count(), 3)
+        obj = TestDoc.objects.get(pk=obj.pk)
+        self.assertEqual(str(obj.description), "line 0 line 1 line 2 ")
+        self.assertTrue(obj.yjs_compaction_due)
+
+        TestDoc.compact_yjs_updates(obj.pk)
+        self.assertEqual(YDocUpdate.for_object(obj).count(), 0)
+        obj = TestDoc.objects.get(pk=obj.pk)
+        self.assertEqual(str(obj.description), "line 0 line 1 line 2 ")
+        self.assertFalse(obj.yjs_compaction_due)
+
+
+class CompressionTestCase(TestCase):
+    def stored(self, model, column: str, pk) -> bytes:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT {connection.ops.quote_name(column)} FROM {model._meta.db_table} WHERE id = %s",
+                [pk],
+            )
+            return bytes(cursor.fetchone()[0])
+
+    def test_compressed_and_rewritten(self):
+        text = "lorem ipsum dolor sit amet " * 50
+        obj = TestDoc.objects.create()
+        obj.description.children.append(text)
+        obj.save()
+        entry = History.for_object(obj, recent_first=True).first()
+        raw = self.stored(TestDoc, "yjs_doc", obj.pk)
+        self.assertFalse(raw.startswith(compression.MAGIC))
+
+        with override_settings(YJS_COMPRESSION="zlib"):
+            call_command("compress_yjs_blobs", stdout=StringIO())
+            stored = self.stored(TestDoc, "yjs_doc", obj.pk)
+            self.assertTrue(stored.startswith(compression.MAGIC))
+            self.assertLess(len(stored), len(raw))
+            self.assertTrue(self.stored(History, "update", entry.id).startswith(compression.MAGIC))
+
+            obj = TestDoc.objects.get(pk=obj.pk)
+            self.assertEqual(str(obj.description), text)
+            obj.description.children.append(text)
+            obj.save()
+            self.assertTrue(
+                self.stored(TestDoc, "yjs_doc", obj.pk).startswith(compression.MAGIC)
+            )
+
+        # Read back whatever the setting
+        self.assertEqual(str(TestDoc.objects.get(pk=obj.pk).description), text * 2)
+        self.assertEqual(
+            str(History.replay(obj, entry.id).get("description", type=pycrdt.XmlFragment)), text
+        )
+
+        call_command("compress_yjs_blobs", stdout=StringIO())
+        self.assertFalse(self.stored(TestDoc, "yjs_doc", obj.pk).startswith(compression.MAGIC))
+        self.assertEqual(str(TestDoc.objects.get(pk=obj.pk).description), text * 2)
+
+    def test_raw_update_starting_with_magic(self):
+        # 11519 clients, the first with 67 structs and an ID of several bytes
+        raw = compression.MAGIC + b"\xfe\x59" + bytes(100)
+        self.assertFalse(compression.is_compressed(raw))
+        self.assertEqual(compression.decompress(raw), raw)
+        with override_settings(YJS_COMPRESSION="zlib"):
+            compressed = compression.compress(raw)
+            self.assertTrue(compression.is_compressed(compressed))
+            self.assertEqual(compression.decompress(compressed), raw)
+
+
+class TiptapToHtmlTestCase(TestCase):
+    def setUp(self):
+        self.doc = pycrdt.Doc()
+        self.frag = self.doc.get("contents", type=pycrdt.XmlFragment)
+        paragraph = self.frag.children.append(
+            pycrdt.XmlElement("paragraph", {}, [pycrdt.XmlText()])
+        )
+        self.text = paragraph.children[0]
+        self.text.insert(0, "hello <world>", {"bold": True})
+
+    def test_render(self):
+        self.assertEqual(
+            str(TiptapToHtml(self.frag)),
+            '<p data-yjs-tag="paragraph" class=""><span class="bold">hello &lt;world&gt;</span></p>',
+        )
+
+    def test_stream(self):
+        self.frag.children.append(pycrdt.XmlElement("paragraph", {}, [pycrdt.XmlText()]))
+        self.frag.children.append(pycrdt.XmlElement("hardBreak", {}, []))
+        chunks = list(TiptapToHtml.stream(self.frag, chunk_size=1))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual("".join(chunks), str(TiptapToHtml(self.frag)))
+
+    def test_render_without_sibling_links(self):
+        self.frag.children.append(pycrdt.XmlElement("paragraph", {}, [pycrdt.XmlText("second")]))
+        expected = str(TiptapToHtml(self.frag))
+        with mock.patch("collab_poc_app.tiptap_to_html._integrated_to_wrapper", None):
+            self.assertEqual(str(TiptapToHtml(self.frag)), expected)
+
+    def test_export_view(self):
+        obj = TestDoc.objects.create()
+        obj.contents.children.append(
+            pycrdt.XmlElement("paragraph", {}, [pycrdt.XmlText("exported text")])
+        )
+        obj.save()
+        self.client.force_login(User.objects.create_user("exporter"))
+        response = self.client.get(f"/{obj.pk}/export")
+        self.assertTrue(response.streaming)
+        self.assertIn(
+            '<p data-yjs-tag="paragraph" class=""><span>exported text</span></p>',
+            b"".join(response.streaming_content).decode(),
+        )
+
+    def test_text_diff(self):
+        events = observe_history(self.frag)
+        html = TiptapToHtml(self.frag)
+        with self.doc.transaction():
+            self.text.insert(6, "big ")
+            del self.text[0:1]
+        for is_text, path, delta, keys in events:
+            self.assertTrue(is_text)
+            html.apply_text_event(path, delta)
+        self.assertEqual(
+            str(html),
+            '<p data-yjs-tag="paragraph" class="">'
+            '<span class="bold changeset-deleted">h</span>'
+            '<span class="bold">ello </span>'
+            '<span class="changeset-added">big </span>'
+            '<span class="bold">&lt;world&gt;</span>'
+            "</p>",
+        )
+
+    def test_text_format_diff(self):
+        self.text.insert(len(self.text), " again")
+        events = observe_history(self.frag)
+        html = TiptapToHtml(self.frag)
+        self.text.format(9, 16, {"italic": True})
+        for is_text, path, delta, keys in events:
+            html.apply_text_event(path, delta)
+        self.assertEqual(
+            str(html),
+            '<p data-yjs-tag="paragraph" class="">'
+            '<span class="bold">hello &lt;wo</span>'
+            '<span class="bold italic changeset-edited">rld&gt;</span>'
+            '<span class="italic changeset-edited"> ag</span>'
+            "<span>ain</span>"
+            "</p>",
+        )
@@ -1,13 +1,143 @@
+from bisect import bisect_left
 import logging
 from typing import Any, Callable, Iterable, Iterator, TypeVar
 import pycrdt
-from xml.dom.minidom import Document, DocumentFragment, Node, Element, Text
 from django.utils.safestring import SafeString
 
+try:
+    # Not public API, so `_iter_children` falls back to plain `children` iteration without it
+    from pycrdt._xml import _integrated_to_wrapper
+except ImportError:
+    _integrated_to_wrapper = None
+
 logger = logging.getLogger(__name__)
 
 T = TypeVar("T")
 
+# Bump when the generated HTML changes, so that cached renders are not reused.
+RENDERER_VERSION = 2
+
+
+def _escape(data: str) -> str:
+    # Same escaping as minidom's `toxml`
+    return (
+        data.replace("&", "&amp;")
+        .replace("<", "&lt;")
+        .replace('"', "&quot;")
+        .replace(">", "&gt;")
+    )
+
+
+class Text:
+    """
+    Text node of the tree built by `TiptapToHtml`.
+    """
+
+    __slots__ = ("data", "parentNode")
+
+    data: str
+    parentNode: "Element | None"
+
+    def __init__(self, data: str) -> None:
+        self.data = data
+        self.parentNode = None
+
+    def _write(self, out: list[str]) -> None:
+        out.append(_escape(self.data))
+
+
+class Element:
+    """
+    Element of the tree built by `TiptapToHtml`.
+
+    A lightweight stand-in for `xml.dom.minidom.Element`, implementing only the subset of its interface
+    (with the same names) that the converter needs, with slotted attributes and list-backed children.
+    """
+
+    __slots__ = ("tagName", "attributes", "childNodes", "parentNode")
+
+    tagName: str
+    attributes: dict[str, str]
+    childNodes: list["Element | Text"]
+    parentNode: "Element | None"
+
+    def __init__(self, tagName: str) -> None:
+        self.tagName = tagName
+        self.attributes = {}
+        self.childNodes = []
+        self.parentNode = None
+
+    def getAttribute(self, name: str) -> str:
+        return self.attributes.get(name, "")
+
+    def hasAttribute(self, name: str) -> bool:
+        return name in self.attributes
+
+    def setAttribute(self, name: str, value: str) -> None:
+        self.attributes[name] = value
+
+    def removeAttribute(self, name: str) -> None:
+        self.attributes.pop(name, None)
+
+    def appendChild(self, node: "Element | Text") -> None:
+        node.parentNode = self
+        self.childNodes.append(node)
+
+    def insertBefore(self, node: "Element | Text", ref: "Element | Text | None") -> None:
+        """
+        Inserts `node` before the child `ref`, or at the end if `ref` is None.
+        """
+        if ref is None:
+            return self.appendChild(node)
+        node.parentNode = self
+        self.childNodes.insert(self.childNodes.index(ref), node)
+
+    def _write_start(self, out: list[str]) -> None:
+        """
+        Writes the start tag, without its closing `>` or `/>`.
+        """
+        out.append("<" + self.tagName)
+        for name, value in self.attributes.items():
+            out.append(f' {name}="{_escape(value)}"')
+
+    def _write(self, out: list[str]) -> None:
+        self._write_start(out)
+        if not self.childNodes:
+            out.append("/>")
+            return
+        out.append(">")
+        for child in self.childNodes:
+            child._write(out)
+        out.append(f"</{self.tagName}>")
+
+
+Node = Element | Text
+
+
+def _iter_children(
+    yxml: pycrdt.XmlElement | pycrdt.XmlFragment,
+) -> Iterator[pycrdt.XmlElement | pycrdt.XmlText]:
+    """
+    Iterates over the children of an element or fragment.
+
+    `XmlChildrenView.__iter__` looks up every child by index, which walks the children from the start each time,
+    and does all of that before returning the first one. This follows the sibling links instead, where the pycrdt
+    build has them.
+    """
+    children = yxml.children
+    if len(children) == 0:
+        return
+    first = children[0]
+    siblings = getattr(getattr(first, "integrated", None), "siblings", None)
+    if _integrated_to_wrapper is None or siblings is None:
+        yield from children
+        return
+    with yxml.doc.transaction() as txn:
+        following = siblings(txn._txn)
+    yield first
+    for sibling in following:
+        yield _integrated_to_wrapper(yxml.doc, sibling)
+
 
 class TiptapToHtml:
     """
@@ -24,21 +154,46 @@ class TiptapToHtml:
     `XmlElements` are converted to their HTML equivalent. `XmlText` segments are converted to a sequence of
     `span`, `a`, or other inline elements - one for each "diff" segment of the text.
 
-    The generated HTML is stored as an XML document so that it can be navigated for applying event diffs.
-    `__str__` converts the document to XHTML for inclusion in a document.
+    The generated HTML is stored as a tree of this module's `Element` and `Text` nodes so that it can be
+    navigated for applying event diffs. `__str__` serializes the tree to XHTML for inclusion in a document.
     """
 
-    xhtmldoc: Document
-    xhtmlfrag: DocumentFragment
+    xhtmlfrag: Element
 
-    def __init__(self, yxml: pycrdt.XmlFragment) -> None:
-        self.xhtmldoc = Document()
-        self.xhtmlfrag = self.xhtmldoc.createDocumentFragment()
-        for node in self._convert(yxml):
-            self.xhtmlfrag.appendChild(node)
+    def __init__(self, yxml: pycrdt.XmlFragment | None = None) -> None:
+        # Root of the tree; only its children are serialized. Empty without `yxml`.
+        self.xhtmlfrag = Element("")
+        if yxml is not None:
+            for node in self._convert(yxml):
+                self.xhtmlfrag.appendChild(node)
 
     def __str__(self) -> SafeString:
-        return SafeString("".join(node.toxml() for node in self.xhtmlfrag.childNodes))
+        out: list[str] = []
+        for node in self.xhtmlfrag.childNodes:
+            node._write(out)
+        return SafeString("".join(out))
+
+    @classmethod
+    def stream(cls, yxml: pycrdt.XmlFragment, chunk_size: int = 8192) -> Iterator[str]:
+        """
+        Renders a fragment to XHTML without building the tree, yielding chunks of roughly `chunk_size` characters.
+
+        The output is the same as `str(TiptapToHtml(yxml))`, but only one node's worth of tree is in memory at a
+        time. For read-only rendering; diff markup needs the full tree.
+        """
+        # The handlers don't use the converted tree, so skip building it
+        converter = cls()
+        buffer: list[str] = []
+        size = 0
+        for piece in converter._stream_children(yxml):
+            buffer.append(piece)
+            size += len(piece)
+            if size >= chunk_size:
+                yield "".join(buffer)
+                buffer.clear()
+                size = 0
+        if buffer:
+            yield "".join(buffer)
 
     def _convert(
         self, yxml: pycrdt.XmlElement | pycrdt.XmlText | pycrdt.XmlFragment
@@ -55,13 +210,51 @@ class TiptapToHtml:
     def _convert_children(
         self, yxml: pycrdt.XmlElement | pycrdt.XmlFragment
     ) -> Iterator[Node]:
-        for ch in yxml.children:
+        for ch in _iter_children(yxml):
             yield from self._convert(ch)
 
+    def _stream_children(
+        self, yxml: pycrdt.XmlElement | pycrdt.XmlFragment
+    ) -> Iterator[str]:
+        out: list[str] = []
+        for ch in _iter_children(yxml):
+            if isinstance(ch, pycrdt.XmlText):
+                for text, attrs in ch.diff():
+                    self._convert_text_segment(text, attrs)._write(out)
+                yield from out
+                out.clear()
+            else:
+                yield from self._stream_element(ch)
+
+    def _stream_element(self, yxml: pycrdt.XmlElement) -> Iterator[str]:
+        """
+        Streaming equivalent of `_convert_element`: converts the element on its own, then streams its children.
+        """
+        node = Element("div")
+        node.setAttribute("data-yjs-tag", yxml.tag)
+        self._apply_element_formatting(yxml.tag, node, iter(yxml.attributes))
+
+        out: list[str] = []
+        node._write_start(out)
+        children = self._stream_children(yxml)
+        first = next(children, None)
+        if first is None and not node.childNodes:
+            out.append("/>")
+            yield "".join(out)
+            return
+        out.append(">")
+        # Children added by the tag handler come before the converted ones
+        for child in node.childNodes:
+            child._write(out)
+        yield "".join(out)
+        if first is not None:
+            yield first
+            yield from children
+        yield f"</{node.tagName}>"
+
     def _convert_text_segment(self, text: str, attrs: dict[str, Any] | None) -> Element:
-        text = self.xhtmldoc.createTextNode(text)
-        el = self.xhtmldoc.createElement("span")
-        el.appendChild(text)
+        el = Element("span")
+        el.appendChild(Text(text))
         if attrs:
             self._apply_text_formatting(el, attrs.items())
         return el
@@ -90,7 +283,7 @@ class TiptapToHtml:
         """
         Converts a YJS XmlElement and its children to its XHTML equivalent and returns it.
         """
-        node = self.xhtmldoc.createElement("div")
+        node = Element("div")
         node.setAttribute("data-yjs-tag", yxml.tag)
         self._apply_element_formatting(yxml.tag, node, iter(yxml.attributes))
         for child in self._convert_children(yxml):
@@ -137,135 +330,36 @@ class TiptapToHtml:
 
         assert isinstance(parentNode, Element)
 
-        # Delta sections are specified via adding character offsets. This is more complicated since we have XHTML nodes.
-        # So store the current position as a tuple of the current span we are in and the string offset.
-        #
-        # _advance_characters will return a new span,index
-        current_span = parentNode.childNodes[0]
-        char_index = 0
+        # Delta sections are specified via adding character offsets into the text as it was before the event.
+        # Deleted text stays in the XHTML (marked up) and inserted text does not count towards the offsets,
+        # so `pos` is an offset into the spans as they were before the event, looked up via `_SpanIndex`.
+        spans = _SpanIndex(parentNode.childNodes)
+        pos = 0
 
         for op in delta:
             if "retain" in op:
-                current_span, char_index, segments = self._advance_characters(
-                    current_span, char_index, op["retain"]
-                )
-
+                end = pos + op["retain"]
                 attrs: dict[str, Any] | None = op.get("attributes")
-                if not attrs:
-                    continue
-                for node, slice in segments:
-                    if slice.stop is not None:
-                        node, _, current_span, char_index = (
-                            self._split_span_and_track_pos(
-                                node, slice.stop, current_span, char_index
-                            )
-                        )
-                    if slice.start != 0:
-                        _, node, current_span, char_index = (
-                            self._split_span_and_track_pos(
-                                node, slice.start, current_span, char_index
-                            )
-                        )
-                self._apply_text_formatting(node, attrs.items())
-                add_class(node, "changeset-edited")
+                if attrs:
+                    for node in spans.isolate(pos, end):
+                        self._apply_text_formatting(node, attrs.items())
+                        add_class(node, "changeset-edited")
+                pos = end
             elif "delete" in op:
-                current_span, char_index, segments = self._advance_characters(
-                    current_span, char_index, op["delete"]
-                )
-                for node, slice in segments:
-                    if slice.stop is not None:
-                        node, _, current_span, char_index = (
-                            self._split_span_and_track_pos(
-                                node, slice.stop, current_span, char_index
-                            )
-                        )
-                    if slice.start != 0:
-                        _, node, current_span, char_index = (
-                            self._split_span_and_track_pos(
-                                node, slice.start, current_span, char_index
-                            )
-                        )
+                end = pos + op["delete"]
+                for node in spans.isolate(pos, end):
                     add_class(node, "changeset-deleted")
+                pos = end
             elif "insert" in op:
-                if char_index != 0:
-                    _, current_span = self._split_span(current_span, char_index)
-                    char_index = 0
                 node = self._convert_text_segment(op["insert"], op.get("attributes"))
                 add_class(node, "changeset-added")
-                parentNode.insertBefore(node, current_span)
+                spans.insert(pos, node)
             else:
                 raise ValueError(f"Unrecognized yjs delta: {op!r}")
 
-    @staticmethod
-    def _advance_characters(
-        current_span: Element, char_index: int, num_chars: int
-    ) -> tuple[
-        Element,
-        int,
-        list[tuple[Element, slice]],
-    ]:
-        """
-        Advances by a number of characters specified from a yjs delta.
-
-        Starting at `char_index` bytes into the `current_span` element, advance `num_char` ahead, possibly into the next
-        siblings of the element.
-
-        `current_span` and its siblings must be elements that each have a single text node child.
-
-        Returns a tuple of the element and sibling after advancement, and the list of elements and text sections
-        traversed.
-        """
-        passed_over = []
-        while num_chars > 0:
-            assert len(current_span.childNodes) == 1
-            assert isinstance(current_span.childNodes[0], Text)
-            text: str = current_span.childNodes[0].data
-            if char_index + num_chars >= len(text):
-                passed_over.append(
-                    (
-                        current_span,
-                        slice(char_index, None),
-                    )
-                )
-                num_chars = num_chars + char_index - len(text)
-                current_span = current_span.nextSibling
-                char_index = 0
-            else:
-                passed_over.append(
-                    (current_span, slice(char_index, char_index + num_chars))
-                )
-                char_index += num_chars
-                num_chars = 0
-        return (current_span, char_index, passed_over)
-
-    def _split_span(self, span: Element, offset: int) -> tuple[Element, Element]:
-        """
-        Splits a span that has a single text node child. Copies attributes.
-        """
-        left = self.xhtmldoc.createElement(span.tagName)
-        right = self.xhtmldoc.createElement(span.tagName)
-        for k, v in span.attributes.items():
-            left.setAttribute(k, v)
-            right.setAttribute(k, v)
-        text = span.childNodes[0].data
-        left.appendChild(self.xhtmldoc.createTextNode(text[:offset]))
-        right.appendChild(self.xhtmldoc.createTextNode(text[offset:]))
-        span.parentNode.insertBefore(left, span)
-        span.parentNode.replaceChild(right, span)
-        return (left, right)
-
-    def _split_span_and_track_pos(
-        self, span: Element, offset: int, current_span: Element, char_index: int
-    ) -> tuple[Element, Element, Element, int]:
-        """
-        Split spans and also returns adjusted current_span + char_index if the span being split is the current_span.
-        """
-        is_current = current_span == span
-        left, right = self._split_span(span, offset)
-        if is_current:
-            current_span = right
-            char_index = char_index - len(left.childNodes[0].data)
-        return (left, right, current_span, char_index)
+        parentNode.childNodes = []
+        for node in spans.nodes():
+            parentNode.appendChild(node)
 
     # ######################################################################
     # Element deltas
@@ -441,14 +535,14 @@ class TiptapToHtml:
     ) -> None:
         el.tagName = "div"
         if not el.childNodes:
-            line1 = self.xhtmldoc.createElement("div")
+            line1 = Element("div")
             line1.setAttribute("class", "page-break-line")
             el.appendChild(line1)
-            text = self.xhtmldoc.createElement("div")
+            text = Element("div")
             text.setAttribute("class", "page-break-text")
-            text.appendChild(self.xhtmldoc.createTextNode("Page Break"))
+            text.appendChild(Text("Page Break"))
             el.appendChild(text)
-            line2 = self.xhtmldoc.createElement("div")
+            line2 = Element("div")
             line2.setAttribute("class", "page-break-line")
             el.appendChild(line2)
 
@@ -495,6 +589,96 @@ class TiptapToHtml:
         modify_class(classes, "underline", attr)
 
 
+class _SpanIndex:
+    """
+    Character offset index over the spans of a converted `XmlText`, for `TiptapToHtml.apply_text_event`.
+
+    Offsets are into the text as it was when the index was created. `starts` holds the (sorted) offset that each
+    span in `spans` starts at, so the span containing an offset is found by binary search rather than by walking
+    the siblings. Spans inserted afterwards take up no room in those offsets, so they are kept aside and only
+    merged back in by `nodes`.
+
+    Each span must be an element with a single text node child.
+    """
+
+    __slots__ = ("spans", "starts", "length", "inserts")
+
+    spans: list[Element]
+    starts: list[int]
+    length: int
+    inserts: list[tuple[int, Element]]
+
+    def __init__(self, spans: Iterable[Node]) -> None:
+        self.spans = []
+        self.starts = []
+        self.inserts = []
+        offset = 0
+        for span in spans:
+            assert isinstance(span, Element)
+            assert len(span.childNodes) == 1
+            assert isinstance(span.childNodes[0], Text)
+            self.spans.append(span)
+            self.starts.append(offset)
+            offset += len(span.childNodes[0].data)
+        self.length = offset
+
+    def split_at(self, offset: int) -> int:
+        """
+        Makes sure that a span starts at `offset`, splitting the span containing it if needed.
+
+        Returns the index of the span starting at `offset`, or the number of spans if it is the end of the text.
+        """
+        index = bisect_left(self.starts, offset)
+        if index < len(self.starts) and self.starts[index] == offset:
+            return index
+        if offset >= self.length:
+            assert offset == self.length, "Delta goes past the end of the text"
+            return index
+
+        # Split the span in place: it keeps the left half, and a copy gets the right half
+        left = self.spans[index - 1]
+        text = left.childNodes[0]
+        split = offset - self.starts[index - 1]
+        right = Element(left.tagName)
+        right.attributes = dict(left.attributes)
+        right.appendChild(Text(text.data[split:]))
+        text.data = text.data[:split]
+
+        self.spans.insert(index, right)
+        self.starts.insert(index, offset)
+        return index
+
+    def isolate(self, start: int, end: int) -> list[Element]:
+        """
+        Splits spans so that the characters from `start` to `end` are covered by whole spans, and returns them.
+        """
+        first = self.split_at(start)
+        return self.spans[first : self.split_at(end)]
+
+    def insert(self, offset: int, node: Element) -> None:
+        """
+        Inserts a new span at `offset`, after any already inserted there.
+        """
+        self.split_at(offset)
+        self.inserts.append((offset, node))
+
+    def nodes(self) -> Iterator[Element]:
+        """
+        Iterates over all spans, including the inserted ones, in document order.
+        """
+        # Inserts come in order of offset, since deltas only move forward
+        inserts = iter(self.inserts)
+        pending = next(inserts, None)
+        for start, span in zip(self.starts, self.spans):
+            while pending is not None and pending[0] <= start:
+                yield pending[1]
+                pending = next(inserts, None)
+            yield span
+        while pending is not None:
+            yield pending[1]
+            pending = next(inserts, None)
+
+
 def modify_class(classes: set[str], name: str, value: Any | None):
     """
     If `value` is not None, add `name` to the `classes` set - otherwise removes it.
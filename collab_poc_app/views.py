@@ -1,12 +1,17 @@
-from django.http import HttpRequest, HttpResponse, Http404
+from typing import Any, Iterator
+
+from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
+from django.template.loader import render_to_string
 from django.contrib.auth.decorators import login_required
-from django.core.paginator import Paginator
+from django.core.cache import cache
+from django.utils.html import format_html
+from django.utils.safestring import SafeString, mark_safe
 import pycrdt
 
 from collab_poc_app.models import TestDoc
-from collab_poc_app.tiptap_to_html import TiptapToHtml
-from pycrdt_model.models import History
+from collab_poc_app.tiptap_to_html import RENDERER_VERSION, TiptapToHtml
+from pycrdt_model.models import History, HistoryEvent, HistoryPage
 
 
 @login_required
@@ -34,6 +39,25 @@ def doc(request: HttpRequest, pk: int) -> HttpResponse:
     )
 
 
+@login_required
+def export(request: HttpRequest, pk: int) -> StreamingHttpResponse:
+    """
+    Read-only HTML export of a document, streamed field by field as it is rendered.
+    """
+    doc_model = get_object_or_404(TestDoc, pk=pk)
+    doc = doc_model.yjs_doc
+
+    def chunks() -> Iterator[str]:
+        yield render_to_string("poc/doc_export_head.html", {"doc": doc_model}, request)
+        for key, pretty_name in TestDoc.RICH_TEXT_FIELDS:
+            yield format_html('<h2>{}</h2>\n<div class="export-field">', pretty_name)
+            yield from TiptapToHtml.stream(doc.get(key, type=pycrdt.XmlFragment))
+            yield "</div>\n"
+        yield "</body>\n</html>\n"
+
+    return StreamingHttpResponse(chunks(), content_type="text/html; charset=utf-8")
+
+
 def observe_history(frag: pycrdt.XmlFragment):
     out_list = list()
 
@@ -48,15 +72,168 @@ def observe_history(frag: pycrdt.XmlFragment):
     return out_list
 
 
+def history_diff_cache_key(history_id: int, field: str) -> str:
+    return f"poc-history-diff:{RENDERER_VERSION}:{history_id}:{field}"
+
+
+def history_view_cache_key(history_id: int) -> str:
+    return f"poc-history-view:{RENDERER_VERSION}:{history_id}"
+
+
+def apply_history_event(html: TiptapToHtml, event: HistoryEvent) -> None:
+    """
+    Marks up the changes of a `HistoryEvent` observed on a rich text field.
+    """
+    # Events of an `XmlFragment` always have a delta, and their paths are child indexes
+    path = [int(index) for index in event.path]
+    if event.is_text:
+        html.apply_text_event(path, event.delta or [])
+    else:
+        html.apply_element_event(path, event.delta or [], event.keys or {})
+
+
+def cache_history_diffs(html_diffs: dict[int, list[SafeString]]) -> None:
+    """
+    Caches the rendered diffs of each rich text field for history entries.
+
+    History entries never change once written, so the cache entries don't expire. `RENDERER_VERSION`
+    is part of the key, so changes to the renderer don't serve stale markup.
+    """
+    cache.set_many(
+        {
+            history_diff_cache_key(history_id, name): diff
+            for history_id, diffs in html_diffs.items()
+            for (name, _), diff in zip(TestDoc.RICH_TEXT_FIELDS, diffs)
+        },
+        timeout=None,
+    )
+
+
+def get_cached_history_diffs(entries: list[History]) -> dict[int, list[SafeString]]:
+    """
+    Gets the rendered diffs of each rich text field for the history entries that have all of them cached.
+    """
+    keys = [
+        history_diff_cache_key(entry.id, name)
+        for entry in entries
+        for name, _ in TestDoc.RICH_TEXT_FIELDS
+    ]
+    cached = cache.get_many(keys)
+    diffs = {}
+    for entry in entries:
+        try:
+            diffs[entry.id] = [
+                mark_safe(cached[history_diff_cache_key(entry.id, name)])
+                for name, _ in TestDoc.RICH_TEXT_FIELDS
+            ]
+        except KeyError:
+            pass
+    return diffs
+
+
+def render_history_diffs(
+    doc_model: TestDoc, start_id: int, end_id: int, render_ids: set[int]
+) -> dict[int, list[SafeString]]:
+    """
+    Renders the diffs of each rich text field for the history entries in `render_ids`, and caches them
+    with `cache_history_diffs`.
+    """
+    roots = {key: pycrdt.XmlFragment for key, _ in TestDoc.RICH_TEXT_FIELDS}
+    render_ids_left = set(render_ids)
+
+    html_diffs: dict[int, list[SafeString]] = {}
+    delta_render: list[TiptapToHtml] = []
+    instance: History | None
+    for instance, doc, frag_events in History.replay_range(
+        doc_model, start_id, end_id, roots
+    ):
+        if instance is not None and instance.id in render_ids_left:
+            for html, key in zip(delta_render, roots):
+                for event in frag_events[key]:
+                    apply_history_event(html, event)
+            html_diffs[instance.id] = [mark_safe(str(html)) for html in delta_render]
+            render_ids_left.discard(instance.id)
+        if not render_ids_left:
+            break
+        # Render the state before the next entry, so its changes can be marked up on it
+        delta_render = [
+            TiptapToHtml(doc.get(key, type=pycrdt.XmlFragment)) for key in roots
+        ]
+
+    cache_history_diffs(html_diffs)
+    return html_diffs
+
+
+def _plain_history_event(event: HistoryEvent) -> HistoryEvent:
+    # Inserted elements are pycrdt objects, which can't be cached, so only their markup is kept
+    if event.delta is None:
+        return event
+    delta = []
+    for op in event.delta:
+        if "insert" in op and not isinstance(op["insert"], str):
+            op = {**op, "insert": [str(item) for item in op["insert"]]}
+        delta.append(op)
+    return event._replace(delta=delta)
+
+
+def render_history_view(doc_model: TestDoc, entry: History) -> tuple[dict[str, Any], list[SafeString]]:
+    """
+    Renders the details of a history entry shown by `history_view`, and its diffs, caching both.
+
+    Returns the details: the `non_collab_fields` it changed, and per rich text field, the field before and
+    after it and the events it made.
+    """
+    roots: dict[str, type] = {key: pycrdt.XmlFragment for key, _ in TestDoc.RICH_TEXT_FIELDS}
+    roots["non_collab_fields"] = pycrdt.Map
+    before: list[str] = []
+    delta_render: list[TiptapToHtml] = []
+    for replayed, doc, events in History.replay_range(doc_model, entry.id, entry.id, roots):
+        frags = [doc.get(key, type=pycrdt.XmlFragment) for key, _ in TestDoc.RICH_TEXT_FIELDS]
+        if replayed is None:
+            # The state before the entry
+            before = [str(TiptapToHtml(frag)) for frag in frags]
+            delta_render = [TiptapToHtml(frag) for frag in frags]
+            continue
+        for html, (key, _) in zip(delta_render, TestDoc.RICH_TEXT_FIELDS):
+            for event in events[key]:
+                apply_history_event(html, event)
+        details = {
+            "non_collab_fields_changed": [
+                name for event in events["non_collab_fields"] for name in event.keys or {}
+            ],
+            "before": before,
+            "after": [str(TiptapToHtml(frag)) for frag in frags],
+            "events": [
+                [_plain_history_event(event) for event in events[key]]
+                for key, _ in TestDoc.RICH_TEXT_FIELDS
+            ],
+        }
+    diffs = [mark_safe(str(html)) for html in delta_render]
+
+    cache_history_diffs({entry.id: diffs})
+    cache.set(history_view_cache_key(entry.id), details, timeout=None)
+    return details, diffs
+
+
+def _get_id_param(request: HttpRequest, name: str) -> int | None:
+    try:
+        return int(request.GET[name])
+    except (KeyError, ValueError):
+        return None
+
+
 @login_required
 def history_list(request: HttpRequest, pk: int) -> HttpResponse:
     doc_model = get_object_or_404(TestDoc, pk=pk)
 
-    history_qs = History.for_object(doc_model, recent_first=True)
-    history_paginator = Paginator(history_qs, 30, allow_empty_first_page=True)
-    history_page = history_paginator.get_page(request.GET.get("page"))
+    history_page: HistoryPage = History.page_for_object(
+        doc_model,
+        30,
+        before=_get_id_param(request, "before"),
+        after=_get_id_param(request, "after"),
+    )
 
-    if not history_page:
+    if not history_page.entries:
         # Don't bother restoring doc for an empty page
         return render(
             request,
@@ -68,25 +245,15 @@ def history_list(request: HttpRequest, pk: int) -> HttpResponse:
             },
         )
 
-    doc = History.replay(doc_model, history_page[-1].id, until_id_inclusive=False)
-    frags = [
-        doc.get(key, type=pycrdt.XmlFragment) for key, _ in TestDoc.RICH_TEXT_FIELDS
-    ]
-    frag_events = [observe_history(frag) for frag in frags]
-
-    html_diffs_per_instance: list[list[TiptapToHtml]] = []
-    instance: History
-    for instance in reversed(history_page):
-        delta_render = [TiptapToHtml(frag) for frag in frags]
-        doc.apply_update(instance.update)
-        for html, events in zip(delta_render, frag_events):
-            for is_text, path, delta, keys in events:
-                if is_text:
-                    html.apply_text_event(path, delta)
-                else:
-                    html.apply_element_event(path, delta, keys)
-            events.clear()
-        html_diffs_per_instance.append([str(html) for html in delta_render])
+    page_entries: list[History] = list(reversed(history_page.entries))
+    html_diffs = get_cached_history_diffs(page_entries)
+    missing_ids = [entry.id for entry in page_entries if entry.id not in html_diffs]
+    if missing_ids:
+        html_diffs.update(
+            render_history_diffs(
+                doc_model, missing_ids[0], missing_ids[-1], set(missing_ids)
+            )
+        )
 
     entries = (
         (
@@ -94,13 +261,13 @@ def history_list(request: HttpRequest, pk: int) -> HttpResponse:
             (
                 (name, pretty_name, diff)
                 for (name, pretty_name), diff in zip(
-                    TestDoc.RICH_TEXT_FIELDS, html_diffs_per_field
+                    TestDoc.RICH_TEXT_FIELDS, html_diffs[instance.id]
                 )
             ),
         )
-        for instance, html_diffs_per_field in zip(
-            history_page, reversed(html_diffs_per_instance)
-        )
+        for instance in history_page.entries
+        # Squashed away since the page was loaded
+        if instance.id in html_diffs
     )
 
     return render(
@@ -117,35 +284,12 @@ def history_list(request: HttpRequest, pk: int) -> HttpResponse:
 @login_required
 def history_view(request: HttpRequest, doc_pk: int, history_pk: int) -> HttpResponse:
     doc_model = get_object_or_404(TestDoc, pk=doc_pk)
+    history_entry = get_object_or_404(History.for_object(doc_model), id=history_pk)
 
-    res = History.replay_until(doc_model, history_pk)
-    if res is None:
-        raise Http404()
-    doc, history_entry = res
-
-    non_collab_fields_changed = []
-    doc.get("non_collab_fields", type=pycrdt.Map).observe(
-        lambda ev: non_collab_fields_changed.extend(ev.keys)
-    )
-
-    frags = [
-        doc.get(key, type=pycrdt.XmlFragment) for key, _ in TestDoc.RICH_TEXT_FIELDS
-    ]
-    events = [observe_history(frag) for frag in frags]
-    before = [str(TiptapToHtml(frag)) for frag in frags]
-    delta_render = [TiptapToHtml(frag) for frag in frags]
-
-    doc.apply_update(history_entry.update)
-
-    after = [str(TiptapToHtml(frag)) for frag in frags]
-    for html, evs in zip(delta_render, events):
-        for is_text, path, delta, keys in evs:
-            if is_text:
-                html.apply_text_event(path, delta)
-            else:
-                html.apply_element_event(path, delta, keys)
-
-    print("DEBUG:", str(frags[1]), flush=True)
+    details = cache.get(history_view_cache_key(history_entry.id))
+    diffs = get_cached_history_diffs([history_entry]).get(history_entry.id)
+    if details is None or diffs is None:
+        details, diffs = render_history_view(doc_model, history_entry)
 
     return render(
         request,
@@ -153,14 +297,14 @@ def history_view(request: HttpRequest, doc_pk: int, history_pk: int) -> HttpResp
         {
             "doc": doc_model,
             "history_entry": history_entry,
-            "non_collab_fields_changed": non_collab_fields_changed,
+            "non_collab_fields_changed": details["non_collab_fields_changed"],
             "collab_fields": list(
                 zip(
                     (pretty for pretty, _ in TestDoc.RICH_TEXT_FIELDS),
-                    before,
-                    after,
-                    delta_render,
-                    events,
+                    details["before"],
+                    details["after"],
+                    diffs,
+                    details["events"],
                 )
             ),
         },
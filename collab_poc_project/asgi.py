@@ -18,7 +18,13 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "collab_poc_project.settings")
 django_asgi_app = get_asgi_application()
 
 from collab_poc_app.routing import websocket_urlpatterns
-from pycrdt_model.consumers import YjsSaverWorkerConsumer, DEFAULT_WORKER_CHANNEL_NAME
+from django.conf import settings
+from pycrdt_model import metrics
+from pycrdt_model.consumers import DEFAULT_WORKER_CHANNEL_NAME, worker_channel_routes
+from pycrdt_model.pending_buffer import RedisPendingBuffer
+
+if settings.YJS_METRICS_PORT:
+    metrics.serve(settings.YJS_METRICS_PORT)
 
 application = ProtocolTypeRouter(
     {
@@ -27,9 +33,15 @@ application = ProtocolTypeRouter(
             AuthMiddlewareStack(URLRouter(websocket_urlpatterns))
         ),
         "channel": ChannelNameRouter(
-            {
-                DEFAULT_WORKER_CHANNEL_NAME: YjsSaverWorkerConsumer.as_asgi(),
-            }
+            worker_channel_routes(
+                DEFAULT_WORKER_CHANNEL_NAME,
+                settings.YJS_SAVE_WORKER_SHARDS,
+                pending_buffer=(
+                    RedisPendingBuffer.from_url(settings.YJS_PENDING_BUFFER_URL)
+                    if settings.YJS_PENDING_BUFFER_URL
+                    else None
+                ),
+            )
         ),
     }
 )
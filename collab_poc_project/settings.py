@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -137,6 +138,28 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Number of saver workers to spread documents over. With more than one, run a worker on each of the
+# channels `yjs-save-0` to `yjs-save-<n - 1>`, and set the same value for the web server.
+YJS_SAVE_WORKER_SHARDS = int(os.environ.get("YJS_SAVE_WORKER_SHARDS", "1"))
+
+# Redis URL where saver workers keep a copy of unsaved updates, so they survive a worker restart.
+# Unset to only keep them in memory.
+YJS_PENDING_BUFFER_URL = os.environ.get("YJS_PENDING_BUFFER_URL") or None
+
+# Where consumer and worker metrics go; see `pycrdt_model.metrics`. For example
+# `pycrdt_model.metrics.Registry` to scrape them from a server on `YJS_METRICS_PORT`, which should only be
+# reachable internally, or from `/metrics` as a staff user. Unset to not collect them.
+YJS_METRICS_SINK = os.environ.get("YJS_METRICS_SINK") or None
+YJS_METRICS_PORT = int(os.environ.get("YJS_METRICS_PORT", "0")) or None
+
+# Exporter for spans timing each save of the saver workers, see `pycrdt_model.profiling`. For example
+# `pycrdt_model.profiling.LoggingSpanExporter` to log them.
+YJS_SPAN_EXPORTER = os.environ.get("YJS_SPAN_EXPORTER") or None
+
+# Compression of stored docs and history, `zlib` or `zstd`; see `pycrdt_model.compression`. After changing
+# it, run `manage.py compress_yjs_blobs` to rewrite existing rows.
+YJS_COMPRESSION = os.environ.get("YJS_COMPRESSION") or None
+
 
 LOGGING = {
     "version": 1,
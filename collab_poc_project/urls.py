@@ -1,8 +1,11 @@
 from django.contrib import admin
 from django.urls import include, path
 
+from pycrdt_model.metrics import metrics_view
+
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics", metrics_view, name="metrics"),
     path("", include("collab_poc_app.urls")),
     path("accounts/", include("django.contrib.auth.urls")),
 ]
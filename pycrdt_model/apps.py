@@ -1,6 +1,18 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.models.signals import post_migrate
+from django.utils.module_loading import import_string
 
 
 class PycrdtModelApp(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "pycrdt_model"
+
+    def ready(self):
+        from pycrdt_model.models import clear_content_type_ids
+
+        post_migrate.connect(clear_content_type_ids)
+
+        exporter = getattr(settings, "YJS_SPAN_EXPORTER", None)
+        if exporter:
+            import_string(exporter)().connect()
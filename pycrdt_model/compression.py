@@ -0,0 +1,127 @@
+"""
+Optional compression of the yjs blobs stored by `YDocField` and `CompressedBinaryField`.
+
+Set `YJS_COMPRESSION` to `"zlib"` or `"zstd"` (which needs the `zstandard` package) to compress blobs as they
+are written, and optionally `YJS_COMPRESSION_LEVEL` to the codec's compression level. Compressed blobs start
+with `MAGIC` followed by a byte identifying the codec, so they are read back whatever the current setting.
+Blobs written before compression was turned on, and those that don't get smaller, are stored raw; use the
+`compress_yjs_blobs` command to rewrite existing rows.
+
+A raw yjs update can start with `MAGIC`, but not followed by a codec ID: the first varint of an update is its
+count of clients, which `MAGIC` starts as 11519, and `C` is then the struct count of the first client. Clients
+are written in descending order of ID, so that one's ID is at least 11518 and its first byte has the high bit
+set, which codec IDs don't. `is_compressed` relies on this.
+"""
+
+import zlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+MAGIC = b"\xffYC"
+
+# Blobs smaller than this aren't worth the CPU
+MIN_SIZE = 64
+
+
+class Codec:
+    """
+    Compression algorithm, identified in stored blobs by `id`, which must be below 0x80.
+    """
+
+    id: int
+    name: str
+    default_level: int
+
+    def compress(self, data: bytes, level: int) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+    id = 1
+    name = "zlib"
+    default_level = 6
+
+    def compress(self, data: bytes, level: int) -> bytes:
+        return zlib.compress(data, level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class ZstdCodec(Codec):
+    id = 2
+    name = "zstd"
+    default_level = 3
+
+    @staticmethod
+    def _zstandard():
+        try:
+            import zstandard
+        except ImportError as exc:
+            raise ImproperlyConfigured("zstd compression requires the zstandard package") from exc
+        return zstandard
+
+    def compress(self, data: bytes, level: int) -> bytes:
+        return self._zstandard().ZstdCompressor(level=level).compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._zstandard().ZstdDecompressor().decompress(data)
+
+
+CODECS: dict[str, Codec] = {codec.name: codec for codec in (ZlibCodec(), ZstdCodec())}
+_CODECS_BY_ID: dict[int, Codec] = {codec.id: codec for codec in CODECS.values()}
+
+
+def get_codec() -> Codec | None:
+    """
+    Gets the codec configured by `YJS_COMPRESSION`, or `None` if compression is off.
+    """
+    name = getattr(settings, "YJS_COMPRESSION", None)
+    if not name:
+        return None
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ImproperlyConfigured(
+            f"Unknown YJS_COMPRESSION {name!r}, expected one of {', '.join(CODECS)}"
+        ) from None
+
+
+def is_compressed(data: bytes) -> bool:
+    """
+    Whether a stored blob is compressed rather than a raw update, by its `MAGIC` and a codec ID byte.
+    """
+    return data.startswith(MAGIC) and len(data) > len(MAGIC) and data[len(MAGIC)] < 0x80
+
+
+def compress(data: bytes) -> bytes:
+    """
+    Compresses a blob with the configured codec, if any and if that makes it smaller.
+
+    Blobs that are already compressed are returned as-is.
+    """
+    codec = get_codec()
+    if codec is None or len(data) < MIN_SIZE or is_compressed(data):
+        return data
+    level = getattr(settings, "YJS_COMPRESSION_LEVEL", None)
+    compressed = MAGIC + bytes((codec.id,)) + codec.compress(
+        data, codec.default_level if level is None else level
+    )
+    return compressed if len(compressed) < len(data) else data
+
+
+def decompress(data: bytes) -> bytes:
+    """
+    Decompresses a stored blob. Raw blobs are returned as-is.
+    """
+    if not is_compressed(data):
+        return data
+    try:
+        codec = _CODECS_BY_ID[data[len(MAGIC)]]
+    except KeyError:
+        raise ValueError("Blob is compressed with an unknown codec") from None
+    return codec.decompress(data[len(MAGIC) + 1 :])
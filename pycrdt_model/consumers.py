@@ -1,18 +1,26 @@
 from abc import ABC, abstractmethod
 import asyncio
+from contextvars import ContextVar
+import hashlib
+import heapq
+import time
 from typing import Any, Callable, Coroutine, Generic, TypeVar
 import uuid
 import logging
+from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
-from django.contrib.auth.models import User
 from django.apps import apps
 import pycrdt
 from pycrdt_websocket.django_channels_consumer import YjsConsumer
 from channels.consumer import AsyncConsumer
 from channels.layers import BaseChannelLayer
+from channels.worker import Worker
 from channels.db import database_sync_to_async
 
+from pycrdt_model import metrics
 from pycrdt_model.models import YDocModel, YDocModelWithHistory
+from pycrdt_model.pending_buffer import RedisPendingBuffer
+from pycrdt_model.signals import pending_post_apply, pending_post_save, pending_pre_load
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +28,163 @@ DEFAULT_WORKER_CHANNEL_NAME: str = "yjs-save"
 
 T = TypeVar("T", bound=YDocModel)
 
+
+def jump_consistent_hash(key: int, num_buckets: int) -> int:
+    """
+    Maps a 64-bit key to a bucket in `range(num_buckets)`.
+
+    Lamping and Veach's jump consistent hash: when the number of buckets changes from n to n+1, only
+    1/(n+1) of the keys move, and they all move to the new bucket.
+    """
+    bucket, j = -1, 0
+    while j < num_buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def worker_channel_names(base_name: str = DEFAULT_WORKER_CHANNEL_NAME, shards: int = 1) -> list[str]:
+    """
+    Names of the channels of `shards` saver workers: `base_name` itself if there's one, otherwise
+    `<base_name>-0` to `<base_name>-<shards - 1>`.
+    """
+    if shards <= 1:
+        return [base_name]
+    return [f"{base_name}-{shard}" for shard in range(shards)]
+
+
+def worker_channel_for(
+    model: type[YDocModel], pk: Any, base_name: str = DEFAULT_WORKER_CHANNEL_NAME, shards: int = 1
+) -> str:
+    """
+    Picks the saver worker channel of a document, out of `worker_channel_names(base_name, shards)`.
+
+    All updates of a document go to the same worker, so its pending state is never split between
+    processes. Uses `jump_consistent_hash`, so adding a shard only moves the documents that the new
+    worker takes over.
+    """
+    names = worker_channel_names(base_name, shards)
+    if len(names) == 1:
+        return names[0]
+    digest = hashlib.blake2b(
+        f"{model._meta.label_lower}:{pk}".encode(), digest_size=8
+    ).digest()
+    return names[jump_consistent_hash(int.from_bytes(digest, "big"), len(names))]
+
+
+def worker_channel_routes(
+    base_name: str = DEFAULT_WORKER_CHANNEL_NAME,
+    shards: int = 1,
+    consumer: "type[YjsSaverWorkerConsumer] | None" = None,
+    **initkwargs: Any,
+) -> dict[str, Any]:
+    """
+    Routes for a `ChannelNameRouter`, running a saver worker consumer on each of the `shards` channels.
+    `initkwargs` are passed to the consumer.
+
+    Each worker process can then be started on one or more of the channels, with
+    `manage.py runworker <channel>...`.
+    """
+    app = (consumer or YjsSaverWorkerConsumer).as_asgi(**initkwargs)
+    return {name: app for name in worker_channel_names(base_name, shards)}
+
+
+class SaverWorker(Worker):
+    """
+    Channels worker that starts the application of each of its channels as soon as it runs, by sending it a
+    `worker_started` message, instead of on the first message that arrives on the channel.
+
+    A `YjsSaverWorkerConsumer` then saves what was left in its pending buffer right away, even for documents
+    that get no further updates. Run with the `runsaverworker` command.
+    """
+
+    async def handle(self) -> None:
+        for channel in self.channels:
+            queue = self.get_or_create_application_instance(
+                channel, {"type": "channel", "channel": channel}
+            )
+            await queue.put({"type": "worker_started"})
+        await super().handle()
+
+
+class _RoomDoc:
+    ydoc: pycrdt.Doc
+    # Consumers that acquired the doc, in order. The first is the room's leader in this process.
+    consumers: "list[YjsUpdateConsumer]"
+    subscription: pycrdt.Subscription
+
+    def __init__(self, ydoc: pycrdt.Doc) -> None:
+        self.ydoc = ydoc
+        self.consumers = []
+        self.subscription = ydoc.observe(_dispatch_doc_transaction)
+
+    @property
+    def refcount(self) -> int:
+        return len(self.consumers)
+
+
+class _RoomDocRegistry:
+    """
+    Process-local, refcounted registry of room documents.
+
+    All `YjsUpdateConsumer`s in the same room share one `pycrdt.Doc` instead of each socket holding
+    (and applying every update to) its own copy. The doc is evicted when the last consumer releases it.
+
+    `process_id` tells this process' group messages apart from other processes'.
+    """
+    rooms: dict[str, _RoomDoc]
+    process_id: str
+
+    def __init__(self) -> None:
+        self.rooms = {}
+        self.process_id = uuid.uuid4().hex
+
+    def __contains__(self, room_name: str) -> bool:
+        return room_name in self.rooms
+
+    def acquire(
+        self,
+        room_name: str,
+        make_ydoc: Callable[[], pycrdt.Doc],
+        consumer: "YjsUpdateConsumer",
+    ) -> pycrdt.Doc:
+        """
+        Gets the doc for a room, calling `make_ydoc` to create it if no consumer in this process has it open.
+        """
+        room = self.rooms.get(room_name)
+        if room is None:
+            room = self.rooms[room_name] = _RoomDoc(make_ydoc())
+        room.consumers.append(consumer)
+        metrics.set_gauge("yjs_room_sockets", room.refcount, {"room": room_name})
+        return room.ydoc
+
+    def release(self, room_name: str, consumer: "YjsUpdateConsumer") -> None:
+        room = self.rooms[room_name]
+        room.consumers.remove(consumer)
+        if not room.consumers:
+            room.ydoc.unobserve(room.subscription)
+            del self.rooms[room_name]
+        metrics.set_gauge("yjs_room_sockets", room.refcount or None, {"room": room_name})
+
+    def is_leader(self, room_name: str, consumer: "YjsUpdateConsumer") -> bool:
+        room = self.rooms.get(room_name)
+        return room is not None and room.consumers[0] is consumer
+
+
+# Consumer currently applying an update from its websocket. Since room docs are shared, the
+# transaction observer uses this to find which connection (and user) an update came from.
+_receiving_consumer: ContextVar["YjsUpdateConsumer | None"] = ContextVar(
+    "_receiving_consumer", default=None
+)
+
+
+def _dispatch_doc_transaction(ev: pycrdt.TransactionEvent) -> None:
+    consumer = _receiving_consumer.get()
+    if consumer is not None:
+        consumer._doc_transaction_callback(ev)
+
+
 class YjsUpdateConsumer(YjsConsumer, Generic[T], ABC):
     """
     Websocket consumer for handling a connection from y-websockets for a `YDocModel` or
@@ -27,28 +192,62 @@ class YjsUpdateConsumer(YjsConsumer, Generic[T], ABC):
 
     Override the `get_ydoc_model_object` method that returns the object to edit.
 
+    Consumers in the same room and process share a single doc through `room_docs`, so the
+    object's stored doc is only used by the first connection to a room.
+
     Forwards updates to other clients, as well as the `YjsSaverWorkerConsumer` worker for saving.
     Saving updates is debounced, to prevent excessive database traffic and history entries.
     If the model is a `YDocModelWithHistory`, history entries will also be created, with the author
     set to the logged in user (via `self.scope["user"]`).
+
+    If `merge_worker_updates` is set, updates are sent to the worker in the background, and updates
+    received while a send is in flight are merged into a single `doc_updated` message instead of one
+    message per transaction. It is off by default; it only helps when channel layer sends are slow
+    enough for updates to pile up. If a background send fails, the socket is closed, so the client
+    reconnects instead of editing with its updates going unsaved.
+
+    If `worker_shards` is more than one, saving is spread over that many workers, and each document's
+    updates are sent to the one that `worker_channel_for` picks out of `worker_channel_names`.
+
+    With several server processes, the first connection to a room in a process starts from the object's
+    stored doc, joins the room's group, then asks it for the edits it is missing. The leader of each
+    process that has the room open (the first consumer in its `room_docs`) replies with an update from the
+    requester's state vector, which is applied to the doc and sent on to the process' clients, so they
+    catch up with edits that haven't been saved yet. Since the group is joined first, edits made after the
+    reply was sent arrive through the group like any other. To stay up to date, leaders also apply the
+    updates that other processes broadcast to the room. Set `request_room_docs` to `False` to only use the
+    stored doc.
+
+    Reports the sockets connected to each room (`yjs_room_sockets`), and the messages and bytes received
+    (`yjs_messages_received_total`, `yjs_message_bytes_received_total`) to `pycrdt_model.metrics`.
     """
+    worker_channel_base_name: str
+    worker_shards: int
     worker_channel_name: str
     model: type[T]
     pk: Any | None
     connection_id: str
-    updates_to_send: list[dict[str, Any]]
+    updates_to_send: list[bytes]
+    merge_worker_updates: bool = False
+    send_updates_task: asyncio.Task | None
+    room_docs: _RoomDocRegistry = _RoomDocRegistry()
+    request_room_docs: bool = True
 
     def __init__(
         self,
         model: type[T],
         worker_channel_name: str,
+        worker_shards: int = 1,
     ):
         super().__init__()
         self.model = model
         self.pk = None
+        self.worker_channel_base_name = worker_channel_name
+        self.worker_shards = worker_shards
         self.worker_channel_name = worker_channel_name
         self.connection_id = str(uuid.uuid4())
         self.updates_to_send = []
+        self.send_updates_task = None
 
     @abstractmethod
     async def get_ydoc_model_object(self) -> T | None:
@@ -68,9 +267,75 @@ class YjsUpdateConsumer(YjsConsumer, Generic[T], ABC):
             return
         assert isinstance(instance, self.model)
         self.pk = instance.pk
-        self.ydoc = instance.yjs_doc
-        self.ydoc.observe(self._doc_transaction_callback)
-        return await super().connect()
+        self.worker_channel_name = worker_channel_for(
+            self.model, self.pk, self.worker_channel_base_name, self.worker_shards
+        )
+        room_name = self.make_room_name()
+        if room_name not in self.room_docs:
+            # Decoding can query the database, e.g. to apply an incremental storage update log
+            await database_sync_to_async(lambda: instance.yjs_doc)()
+        self.ydoc = self.room_docs.acquire(room_name, lambda: instance.yjs_doc, self)
+        # Joins the group before asking it for edits, so none are missed in between
+        await super().connect()
+        if self.request_room_docs and self.room_docs.is_leader(room_name, self):
+            await self.request_room_doc()
+
+    async def request_room_doc(self) -> None:
+        """
+        Asks other processes that have the room open for the edits that our doc is missing. Replies are
+        handled by `room_doc_snapshot`.
+        """
+        await self.channel_layer.group_send(
+            self.room_name,
+            {
+                "type": "room_doc_request",
+                "origin": self.room_docs.process_id,
+                "reply_channel": self.channel_name,
+                "state": self.ydoc.get_state(),
+            },
+        )
+
+    async def room_doc_request(self, message: dict) -> None:
+        if message["origin"] == self.room_docs.process_id or not self.room_docs.is_leader(
+            self.room_name, self
+        ):
+            return
+        await self.channel_layer.send(
+            message["reply_channel"],
+            {"type": "room_doc_snapshot", "update": self.ydoc.get_update(message["state"])},
+        )
+
+    async def room_doc_snapshot(self, message: dict) -> None:
+        if self.ydoc is None:
+            return
+        # Not forwarded to the worker, since `_receiving_consumer` isn't set; the other process saves it
+        self.ydoc.apply_update(message["update"])
+        update_message = pycrdt.create_update_message(message["update"])
+        for consumer in list(self.room_docs.rooms[self.room_name].consumers):
+            await consumer.send(bytes_data=update_message)
+
+    async def group_send_message(self, message: bytes) -> None:
+        await self.channel_layer.group_send(
+            self.room_name,
+            {
+                "type": "send_message",
+                "message": message,
+                "origin": self.room_docs.process_id,
+            },
+        )
+
+    async def send_message(self, message_wrapper: YjsConsumer.WrappedMessage) -> None:
+        await super().send_message(message_wrapper)
+        message = message_wrapper["message"]
+        if (
+            message_wrapper.get("origin", self.room_docs.process_id) != self.room_docs.process_id
+            and message[0] == pycrdt.YMessageType.SYNC
+            and message[1]
+            in (pycrdt.YSyncMessageType.SYNC_STEP2, pycrdt.YSyncMessageType.SYNC_UPDATE)
+            and self.room_docs.is_leader(self.room_name, self)
+        ):
+            # Not forwarded to the worker: `_receiving_consumer` is only set for our own websocket
+            pycrdt.handle_sync_message(message[1:], self.ydoc)
 
     def make_room_name(self) -> str:
         return "yjs-{}-{}".format(
@@ -85,150 +350,433 @@ class YjsUpdateConsumer(YjsConsumer, Generic[T], ABC):
         if self.ydoc is None:
             logger.warning("%s: received with no ydoc - did `get_ydoc_model_object` return `None` without calling `close`?")
             return
-        await super().receive(text_data=text_data, bytes_data=bytes_data)
+        if bytes_data is not None:
+            is_update = bytes_data[0] == pycrdt.YMessageType.SYNC and bytes_data[1] in (
+                pycrdt.YSyncMessageType.SYNC_STEP2,
+                pycrdt.YSyncMessageType.SYNC_UPDATE,
+            )
+            labels = {"model": self.model._meta.label, "message": "update" if is_update else "other"}
+            metrics.increment("yjs_messages_received_total", labels=labels)
+            metrics.increment("yjs_message_bytes_received_total", len(bytes_data), labels)
+        token = _receiving_consumer.set(self)
+        try:
+            await super().receive(text_data=text_data, bytes_data=bytes_data)
+        finally:
+            _receiving_consumer.reset(token)
         logger.debug("%s: Receive %d bytes", self.connection_id, len(bytes_data))
         # Can't send channel messages inside of the observer callback, since sending is async,
         # the callback is sync, and async_to_sync can't be used since its running in an async
         # thread. So buffer them up and send when we can.
-        for ev in self.updates_to_send:
-            await self.channel_layer.send(self.worker_channel_name, ev)
-        self.updates_to_send.clear()
+        if not self.merge_worker_updates:
+            await self._send_worker_updates()
+        elif self.send_updates_task is None or self.send_updates_task.done():
+            self.send_updates_task = asyncio.create_task(self._send_worker_updates())
+            self.send_updates_task.add_done_callback(self._send_worker_updates_done)
+
+    async def _send_worker_updates(self) -> None:
+        """
+        Sends buffered updates to the worker.
+
+        When merging, updates that arrive while a send is in flight are buffered, then merged and sent
+        together once it completes, so a burst of small websocket messages costs few channel layer sends.
+        """
+        while self.updates_to_send:
+            updates = self.updates_to_send
+            self.updates_to_send = []
+            if self.merge_worker_updates and len(updates) > 1:
+                updates = [pycrdt.merge_updates(*updates)]
+            for update in updates:
+                await self.channel_layer.send(
+                    self.worker_channel_name,
+                    {
+                        "type": "doc_updated",
+                        "connection_id": self.connection_id,
+                        "model_app": self.model._meta.app_label,
+                        "model_name": self.model._meta.model_name,
+                        "model_pk": self.scope["url_route"]["kwargs"]["pk"],
+                        "user_pk": self.scope["user"].pk,
+                        "update_bytes": update,
+                    },
+                )
+
+    def _send_worker_updates_done(self, task: asyncio.Task) -> None:
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.error(
+            "%s: Failed to send updates to the worker",
+            self.connection_id,
+            exc_info=task.exception(),
+        )
+        self.updates_to_send = []
+        if self.ydoc is not None:
+            asyncio.ensure_future(self.close())
 
     def _doc_transaction_callback(self, ev: pycrdt.TransactionEvent):
         logger.debug("%s: Transaction", self.connection_id)
-        self.updates_to_send.append(
-            {
-                "type": "doc_updated",
-                "connection_id": self.connection_id,
-                "model_app": self.model._meta.app_label,
-                "model_name": self.model._meta.model_name,
-                "model_pk": self.scope["url_route"]["kwargs"]["pk"],
-                "user_pk": self.scope["user"].pk,
-                "update_bytes": ev.update,
-            }
-        )
+        self.updates_to_send.append(ev.update)
 
     async def disconnect(self, code) -> None:
-        self.channel_layer.send(
-            self.worker_channel_name,
-            {
-                "type": "doc_flush",
-                "connection_id": self.connection_id,
-            },
-        )
-        await super().disconnect(code)
+        if self.ydoc is None:
+            # Rejected in `get_ydoc_model_object`, never joined the room
+            return
+        self.room_docs.release(self.make_room_name(), self)
+        self.ydoc = None
+        try:
+            # Flush must arrive after any outstanding updates. A failed send was already logged by
+            # `_send_worker_updates_done`, and shouldn't stop the flush or leaving the room.
+            if self.send_updates_task is not None:
+                await asyncio.wait([self.send_updates_task])
+            await self.channel_layer.send(
+                self.worker_channel_name,
+                {
+                    "type": "doc_flush",
+                    "connection_id": self.connection_id,
+                    "model_app": self.model._meta.app_label,
+                    "model_name": self.model._meta.model_name,
+                    "model_pk": self.scope["url_route"]["kwargs"]["pk"],
+                },
+            )
+        finally:
+            await super().disconnect(code)
 
 
-class _DebouncedCallback:
+class _DebounceScheduler:
     """
-    Calls a callback while applying debouncing.
+    Debounce timers for any number of keys, all driven by one task.
 
-    When `trigger` is called, schedules the callback to run after `delay` seconds.
-    If `trigger` is called again before then, the delay is reset.
+    `trigger` only records a deadline of `delay` seconds from now, capped at `max_wait` seconds after the
+    key was first triggered, so that continuous triggering can't postpone the callback forever. Deadlines
+    are kept in a heap, and moving one later doesn't touch the heap: the loop re-queues an entry when it
+    finds its deadline has moved.
     """
-    task_name: str | None
-    task: asyncio.Task | None
-    cb: Callable[[], Coroutine[Any, Any, None]]
 
-    def __init__(
-        self,
-        cb: Callable[[], Coroutine[Any, Any, None]],
-        *,
-        task_name: str | None = None
-    ):
-        self.cb = cb
-        self.task_name = task_name
-        self.ended = False
+    callback: Callable[[str], Coroutine[Any, Any, None]]
+    deadlines: dict[str, float]
+    first_triggered: dict[str, float]
+    queued: dict[str, float]
+    heap: list[tuple[float, str]]
+    task: asyncio.Task | None
+    wakeup: asyncio.Event
+
+    def __init__(self, callback: Callable[[str], Coroutine[Any, Any, None]]) -> None:
+        self.callback = callback
+        self.deadlines = {}
+        self.first_triggered = {}
+        # Deadline of the key's live heap entry; other entries for the key are stale
+        self.queued = {}
+        self.heap = []
         self.task = None
+        self.wakeup = asyncio.Event()
+
+    def trigger(self, key: str, delay: float, max_wait: float | None = None) -> None:
+        now = asyncio.get_running_loop().time()
+        deadline = now + delay
+        if key in self.deadlines:
+            if max_wait is not None:
+                deadline = min(deadline, self.first_triggered[key] + max_wait)
+            self.deadlines[key] = deadline
+            if deadline < self.queued[key]:
+                # Moved earlier than its heap entry; only happens when forcing a flush
+                self._queue(key, deadline)
+            return
 
-    async def _task(self, delay: float):
-        await asyncio.sleep(delay)
-        await self.cb()
-
-    def trigger(self, delay: float):
+        self.deadlines[key] = deadline
+        self.first_triggered[key] = now
+        self._queue(key, deadline)
+
+    def _queue(self, key: str, deadline: float) -> None:
+        self.queued[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run(), name="debounce-scheduler")
+        elif self.heap[0][1] == key:
+            # Now the earliest deadline, so the loop has to wake up earlier than it planned
+            self.wakeup.set()
+
+    def cancel(self, key: str) -> None:
+        self.deadlines.pop(key, None)
+        self.first_triggered.pop(key, None)
+        self.queued.pop(key, None)
+
+    def stop(self) -> None:
         if self.task is not None:
             self.task.cancel()
-        self.task = asyncio.create_task(self._task(delay), name=self.task_name)
 
-    def stop(self):
-        if self.task is not None:
-            self.task.cancel()
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self.heap:
+            deadline, key = self.heap[0]
+            delay = deadline - loop.time()
+            if delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.heap)
+            if self.queued.get(key) != deadline:
+                continue
+            current = self.deadlines[key]
+            if current > deadline:
+                self.queued[key] = current
+                heapq.heappush(self.heap, (current, key))
+                continue
+            self.cancel(key)
+            try:
+                await self.callback(key)
+            except Exception:
+                logger.exception("Debounce callback for %s failed", key)
+
+
+class _PhaseTimer:
+    """
+    Times consecutive phases of a save.
+    """
+
+    timings: dict[str, float]
+    mark: float
+
+    def __init__(self) -> None:
+        self.timings = {}
+        self.mark = time.perf_counter()
+
+    def lap(self, phase: str) -> None:
+        """
+        Ends `phase`, which started when the previous one ended.
+        """
+        now = time.perf_counter()
+        self.timings[phase] = now - self.mark
+        self.mark = now
 
 
 class _PendingState:
     """
     Unsaved state kept in memory until a debounce timeout has passed.
 
-    Update blobs are accumulated in the `updates` list. When the `save_debounce_cb` fires or the websocket
-    disconnects, the document is loaded, updates applied, then saved.
+    Updates are merged per author, as they arrive, into the `updates` dict. Once no updates have come in
+    for `save_debounce_time` seconds, or `max_pending_seconds` after the first one even if they keep
+    coming, or once the merged updates reach `max_pending_bytes`, or when the websocket disconnects, the
+    document is loaded, updates applied, then saved. For a `YDocModelWithHistory`, each author's updates
+    are saved as their own `History` entry.
+
+    Timers are kept by a `_DebounceScheduler`, normally shared by all states of the worker.
+
+    Depending on `YjsSaverWorkerConsumer.coalesce_by_document`, `key` is either the connection ID or
+    the document key, so a state may hold updates from one connection or from everyone editing the doc.
     """
 
     # Higher values reduce database load and number of history entries, but also cause edits to take longer to save.
     save_debounce_time: float = 1.0  # seconds
+    # Longest that updates wait to be saved during continuous editing, or None to wait for a pause.
+    max_pending_seconds: float | None = 10.0
+    # Size of merged updates that forces a save, bounding worker memory (and what a crash loses).
+    max_pending_bytes: int | None = 256 * 1024
 
-    connection_id: str
+    key: str
     model: type[YDocModel]
-    user_pk: int
     doc_pk: int
-    updates: list[bytes]
+    updates: dict[int | None, bytes]
+    pending_bytes: int
+    # Number of updates copied to the worker's `RedisPendingBuffer`, to drop from it once saved
+    buffered_count: int
+    # `time.monotonic()` when a flush was first asked for, to report how long it took
+    flush_requested: float | None
     channel_layer: BaseChannelLayer
     channel_name: str
-    save_debounce_cb: _DebouncedCallback
+    scheduler: _DebounceScheduler
 
     def __init__(
         self,
-        connection_id: str,
+        key: str,
         model: type[YDocModel],
-        user_pk: int,
         doc_pk: int,
         channel_layer: BaseChannelLayer,
         channel_name: str,
+        scheduler: _DebounceScheduler | None = None,
     ) -> None:
-        self.connection_id = connection_id
+        self.key = key
         self.model = model
-        self.user_pk = user_pk
         self.doc_pk = doc_pk
-        self.updates = []
+        self.updates = {}
+        self.pending_bytes = 0
+        self.buffered_count = 0
+        self.flush_requested = None
         self.channel_layer = channel_layer
         self.channel_name = channel_name
-        self.save_debounce_cb = _DebouncedCallback(self._debounce_cb)
+        self.scheduler = (
+            scheduler if scheduler is not None else _DebounceScheduler(self._debounce_cb)
+        )
 
-    async def _debounce_cb(self):
+    async def _debounce_cb(self, key: str) -> None:
         await self.channel_layer.send(
             self.channel_name,
             {
                 "type": "doc_flush",
-                "connection_id": self.connection_id,
+                "pending_key": key,
             },
         )
 
-    def update(self, update_bytes: bytes) -> None:
-        self.updates.append(update_bytes)
-        self.save_debounce_cb.trigger(self.save_debounce_time)
+    def update(self, update_bytes: bytes, user_pk: int | None) -> None:
+        previous = self.updates.get(user_pk)
+        if previous is None:
+            merged = update_bytes
+        else:
+            merged = pycrdt.merge_updates(previous, update_bytes)
+            self.pending_bytes -= len(previous)
+        self.updates[user_pk] = merged
+        self.pending_bytes += len(merged)
+
+        if self.max_pending_bytes is not None and self.pending_bytes >= self.max_pending_bytes:
+            delay = 0.0
+        else:
+            delay = self.save_debounce_time
+        self.scheduler.trigger(self.key, delay, self.max_pending_seconds)
+
+    def clear(self) -> None:
+        self.updates.clear()
+        self.pending_bytes = 0
 
     async def flush(self) -> None:
-        self.save_debounce_cb.stop()
-        if not self.updates:
+        await self.flush_many([self])
+
+    @classmethod
+    async def flush_many(cls, states: list["_PendingState"]) -> None:
+        """
+        Saves the updates of several states at once, with `save_many`.
+
+        If saving a single state fails, the exception is raised and the state keeps its updates, except if
+        its document no longer exists, in which case they are dropped since they can never be saved.
+        """
+        for state in states:
+            state.scheduler.cancel(state.key)
+        states = [state for state in states if state.updates]
+        if not states:
             return
 
-        await database_sync_to_async(self.save)()
-        self.updates.clear()
+        try:
+            instances = await database_sync_to_async(cls.save_many)(states)
+        except Exception as exc:
+            if len(states) == 1:
+                if isinstance(exc, ObjectDoesNotExist):
+                    states[0].clear()
+                raise
+            # Don't let one bad document lose the updates of the rest of the batch
+            logger.exception("Saving a batch failed, saving its states one at a time")
+            for state in states:
+                try:
+                    await cls.flush_many([state])
+                except Exception:
+                    logger.exception("Could not save updates of %s", state.key)
+            return
 
-    def save(self) -> None:
-        with transaction.atomic():
-            instance = self.model.objects.select_for_update().get(pk=self.doc_pk)
-            with instance.yjs_doc.transaction():
-                for update in self.updates:
-                    instance.yjs_doc.apply_update(update)
+        now = time.monotonic()
+        for state, instance in zip(states, instances):
+            if state.flush_requested is not None:
+                metrics.observe("yjs_flush_latency_seconds", now - state.flush_requested)
+                state.flush_requested = None
+            state.clear()
+            if instance.yjs_compaction_due:
+                await state.channel_layer.send(
+                    state.channel_name,
+                    {
+                        "type": "doc_compact",
+                        "model_app": state.model._meta.app_label,
+                        "model_name": state.model._meta.model_name,
+                        "model_pk": state.doc_pk,
+                    },
+                )
+
+    def save(self) -> YDocModel:
+        return self.save_many([self])[0]
+
+    @staticmethod
+    def save_many(states: list["_PendingState"]) -> list[YDocModel]:
+        """
+        Loads, updates and saves the documents of several states in one transaction, returning the instance
+        saved for each.
+
+        The documents of each model are locked with one `select_for_update` query, and the `History` entries of
+        all of them are inserted together by `YDocModelWithHistory.save_many`. States for the same document
+        share one instance, so it is only saved once.
 
-            if isinstance(instance, YDocModelWithHistory):
-                instance.save(user=self.user_pk)
-            else:
-                instance.save()
+        Times each phase: `lock` for the `select_for_update` queries, which is mostly lock wait when another
+        save holds the rows, `load` for decoding the docs, `apply`, and `save` up to the commit. The timings
+        are reported to the `yjs_save_seconds` metric, and sent with the `pending_pre_load`,
+        `pending_post_apply` and `pending_post_save` signals.
+        """
+        update_bytes = sum(
+            len(update) for state in states for update in state.updates.values()
+        )
+        pending_pre_load.send(_PendingState, states=states, update_bytes=update_bytes)
+        timer = _PhaseTimer()
+        with transaction.atomic():
+            # Message pks come from the URL, so normalize them to match `in_bulk`'s keys
+            pks = [state.model._meta.pk.to_python(state.doc_pk) for state in states]
+            locked: dict[type[YDocModel], dict[Any, YDocModel]] = {}
+            for model in {state.model for state in states}:
+                locked[model] = (
+                    model._default_manager.select_for_update()
+                    .order_by("pk")
+                    .in_bulk([pk for state, pk in zip(states, pks) if state.model is model])
+                )
+            timer.lap("lock")
+
+            instances: list[YDocModel] = []
+            for state, pk in zip(states, pks):
+                try:
+                    instance = locked[state.model][pk]
+                except KeyError:
+                    raise state.model.DoesNotExist(
+                        f"{state.model._meta.label} {state.doc_pk} does not exist"
+                    ) from None
+                instances.append(instance)
+
+            for instance in instances:
+                # Decoded lazily; accessed here so it is timed on its own
+                instance.yjs_doc
+            timer.lap("load")
+
+            for state, instance in zip(states, instances):
+                if isinstance(instance, YDocModelWithHistory):
+                    for user_pk, update in state.updates.items():
+                        instance.apply_updates([update], user=user_pk)
+                else:
+                    with instance.yjs_doc.transaction():
+                        for update in state.updates.values():
+                            instance.yjs_doc.apply_update(update)
+            timer.lap("apply")
+            pending_post_apply.send(
+                _PendingState,
+                states=states,
+                instances=instances,
+                update_bytes=update_bytes,
+                timings=dict(timer.timings),
+            )
 
-        if logger.isEnabledFor(logging.DEBUG):
-            user = User.objects.get(pk=self.user_pk)
-            logger.debug("Update from %s: %r", user, instance)
+            # dict to dedupe while keeping order
+            unique = list({id(instance): instance for instance in instances}.values())
+            YDocModelWithHistory.save_many(
+                instance for instance in unique if isinstance(instance, YDocModelWithHistory)
+            )
+            for instance in unique:
+                if not isinstance(instance, YDocModelWithHistory):
+                    instance.save()
+        timer.lap("save")
+
+        for phase, seconds in timer.timings.items():
+            metrics.observe("yjs_save_seconds", seconds, {"phase": phase})
+        pending_post_save.send(
+            _PendingState,
+            states=states,
+            instances=instances,
+            update_bytes=update_bytes,
+            timings=timer.timings,
+        )
+        for state in states:
+            logger.debug("Saved %s, updates from users %s", state.key, list(state.updates))
+        return instances
 
 
 class YjsSaverWorkerConsumer(AsyncConsumer):
@@ -237,35 +785,205 @@ class YjsSaverWorkerConsumer(AsyncConsumer):
 
     Needs to be started for collaborative edits to save. See
     https://channels.readthedocs.io/en/latest/topics/worker.html.
+
+    By default, updates are kept per connection. If `coalesce_by_document` is set, updates are kept
+    per document instead, so that one debounced flush does a single load/apply/save cycle no matter
+    how many people are editing it. Authors are tracked either way.
+
+    For models using `YDocModel.yjs_incremental_storage`, the worker also compacts the update log
+    once a save reports that it's due.
+
+    Flushes are batched: states due within `batch_flush_window` seconds of the first are saved together
+    by `_PendingState.flush_many`, in one transaction. Set it to `None` to save each state on its own.
+
+    The debounce timers of all pending states are kept by one `_DebounceScheduler`, so an update only
+    records a new deadline.
+
+    Pending updates only live in memory, so they are lost if the worker stops before saving them. With a
+    `pending_buffer`, each update is also appended to Redis before it is acknowledged, and dropped from it
+    once saved. Whatever is left in the buffer is saved as soon as the worker starts again. Channels' own
+    `runworker` only starts it on the first message for its channel, so run it with `runsaverworker`.
+
+    States that fail to save are kept, with all their updates, and saved again `save_retry_delay` seconds
+    later or along with their next update. Those whose document was deleted are dropped.
+
+    Reports the number of pending states (`yjs_worker_pending_states`), the time from a flush being asked
+    for to the save (`yjs_flush_latency_seconds`) and the phases of saves (`yjs_save_seconds`) to
+    `pycrdt_model.metrics`.
     """
     pending_state: type[_PendingState] = _PendingState
     pending: dict[str, _PendingState]
+    coalesce_by_document: bool = False
+    batch_flush_window: float | None = 0.05  # seconds
+    save_retry_delay: float = 5.0  # seconds
 
-    def __init__(self) -> None:
+    flush_batch: set[str]
+    flush_batch_task: asyncio.Task | None
+    flush_scheduler: _DebounceScheduler
+    pending_buffer: RedisPendingBuffer | None
+    recovered: bool
+
+    def __init__(self, pending_buffer: RedisPendingBuffer | None = None) -> None:
         super().__init__()
         self.pending = {}
+        self.flush_batch = set()
+        self.flush_batch_task = None
+        self.flush_scheduler = _DebounceScheduler(self._debounce_cb)
+        self.pending_buffer = pending_buffer
+        self.recovered = False
+
+    async def dispatch(self, message: dict) -> None:
+        if not self.recovered:
+            self.recovered = True
+            await self.recover_pending()
+        await super().dispatch(message)
+
+    async def worker_started(self, message: dict) -> None:
+        # Sent by `SaverWorker`; `dispatch` has already recovered the pending buffer
+        pass
 
-    async def doc_updated(self, message: dict) -> None:
-        connection_id: str = message["connection_id"]
-        logger.debug("doc_updated from %s user %s", connection_id, message["user_pk"])
-        if connection_id not in self.pending:
-            model = apps.get_app_config(message["model_app"]).get_model(
-                message["model_name"]
+    async def recover_pending(self) -> None:
+        """
+        Queues a save of the updates left in `pending_buffer` by a worker that stopped before saving them.
+        """
+        if self.pending_buffer is None:
+            return
+        for buffered in await self.pending_buffer.recover(self.scope["channel"]):
+            state = self.pending_state(
+                buffered.key,
+                apps.get_model(buffered.model_label),
+                buffered.doc_pk,
+                self.channel_layer,
+                self.channel_name,
+                self.flush_scheduler,
             )
-            self.pending[connection_id] = self.pending_state(
-                connection_id,
-                model,
-                message["user_pk"],
+            for user_pk, update in buffered.updates:
+                state.update(update, user_pk)
+            state.buffered_count = len(buffered.updates)
+            self.pending[buffered.key] = state
+            self.flush_scheduler.trigger(buffered.key, 0.0)
+            logger.info(
+                "Recovered %d unsaved updates for %s", state.buffered_count, buffered.key
+            )
+        self._report_pending()
+
+    def _report_pending(self) -> None:
+        metrics.set_gauge(
+            "yjs_worker_pending_states", len(self.pending), {"channel": self.scope["channel"]}
+        )
+
+    async def flush_states(self, states: list[_PendingState]) -> None:
+        """
+        Saves states with `_PendingState.flush_many`, then drops the saved updates from `pending_buffer`.
+
+        `states` must have been taken out of `pending`. Those that fail to save are logged and put back,
+        keeping their updates and `buffered_count`, so they are saved again later, along with any later
+        updates, and trimming the buffer doesn't drop updates that were never saved. Failures aren't raised,
+        since that would stop the worker and lose every pending state.
+        """
+        try:
+            await self.pending_state.flush_many(states)
+        except Exception:
+            # Only raised for a single state; `flush_many` logs the states of a batch that fail
+            logger.exception("Could not save updates of %s", states[0].key)
+        for state in states:
+            if state.updates:
+                self.pending[state.key] = state
+                self.flush_scheduler.trigger(state.key, self.save_retry_delay)
+        self._report_pending()
+        if self.pending_buffer is None:
+            return
+        for state in states:
+            if state.buffered_count and not state.updates:
+                await self.pending_buffer.trim(
+                    self.scope["channel"], state.key, state.buffered_count
+                )
+                state.buffered_count = 0
+
+    async def _debounce_cb(self, key: str) -> None:
+        await self.channel_layer.send(
+            self.channel_name, {"type": "doc_flush", "pending_key": key}
+        )
+
+    def pending_key(self, message: dict) -> str:
+        """
+        Gets the key of the `_PendingState` that a `doc_updated` or `doc_flush` message belongs to.
+        """
+        if self.coalesce_by_document:
+            return "{}.{}-{}".format(
+                message["model_app"], message["model_name"], message["model_pk"]
+            )
+        return message["connection_id"]
+
+    @staticmethod
+    def message_model(message: dict) -> type[YDocModel]:
+        """
+        Gets the model of the document that a message is about.
+        """
+        model = apps.get_app_config(message["model_app"]).get_model(message["model_name"])
+        assert issubclass(model, YDocModel)
+        return model
+
+    async def doc_updated(self, message: dict) -> None:
+        key = self.pending_key(message)
+        logger.debug("doc_updated for %s user %s", key, message["user_pk"])
+        if key not in self.pending:
+            self.pending[key] = self.pending_state(
+                key,
+                self.message_model(message),
                 message["model_pk"],
                 self.channel_layer,
                 self.channel_name,
+                self.flush_scheduler,
             )
-        self.pending[connection_id].update(message["update_bytes"])
+            self._report_pending()
+            is_new = True
+        else:
+            is_new = False
+        state = self.pending[key]
+        if self.pending_buffer is not None:
+            await self.pending_buffer.append(
+                self.scope["channel"],
+                key,
+                message["user_pk"],
+                message["update_bytes"],
+                model_label=state.model._meta.label if is_new else None,
+                doc_pk=state.doc_pk,
+            )
+            state.buffered_count += 1
+        state.update(message["update_bytes"], message["user_pk"])
 
     async def doc_flush(self, message: dict) -> None:
-        connection_id: str = message["connection_id"]
-        logger.debug("doc_flush from %s", connection_id)
-        if connection_id not in self.pending:
+        # Sent by our debounce callback with the key, or by a disconnecting consumer
+        key = message.get("pending_key") or self.pending_key(message)
+        logger.debug("doc_flush for %s", key)
+        if key not in self.pending:
+            return
+        if self.pending[key].flush_requested is None:
+            self.pending[key].flush_requested = time.monotonic()
+        if self.batch_flush_window is None:
+            await self.flush_states([self.pending.pop(key)])
             return
-        await self.pending[connection_id].flush()
-        del self.pending[connection_id]
+        self.flush_batch.add(key)
+        if self.flush_batch_task is None:
+            self.flush_batch_task = asyncio.create_task(
+                self._send_flush_batch(self.batch_flush_window)
+            )
+
+    async def _send_flush_batch(self, window: float) -> None:
+        await asyncio.sleep(window)
+        # Handled like any other message, so the flush doesn't run concurrently with the handlers
+        await self.channel_layer.send(self.channel_name, {"type": "doc_flush_batch"})
+
+    async def doc_flush_batch(self, message: dict) -> None:
+        keys = self.flush_batch
+        self.flush_batch = set()
+        self.flush_batch_task = None
+        states = [self.pending.pop(key) for key in keys if key in self.pending]
+        logger.debug("doc_flush_batch for %d states", len(states))
+        await self.flush_states(states)
+
+    async def doc_compact(self, message: dict) -> None:
+        model = self.message_model(message)
+        logger.debug("doc_compact for %s %s", model._meta.label, message["model_pk"])
+        await database_sync_to_async(model.compact_yjs_updates)(message["model_pk"])
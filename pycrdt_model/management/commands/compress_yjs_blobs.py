@@ -0,0 +1,78 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.db.models.functions import Length
+
+from pycrdt_model.models import CompressedBinaryField, YDocField
+
+
+class Command(BaseCommand):
+    help = (
+        "Rewrites every stored yjs doc, history entry, snapshot and update with the current YJS_COMPRESSION "
+        "setting, compressing rows written before it was turned on, or decompressing them if it is off"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Rows to rewrite per transaction",
+        )
+
+    def handle(self, *args, batch_size: int, **options):
+        for model in apps.get_models():
+            if model._meta.proxy or not model._meta.managed:
+                continue
+            # Inherited fields are rewritten with their own model
+            for field in model._meta.get_fields(include_parents=False):
+                if not isinstance(field, (YDocField, CompressedBinaryField)):
+                    continue
+                size_before = self.stored_size(model, field)
+                rows = self.rewrite(model, field, batch_size)
+                self.stdout.write(
+                    f"Rewrote {rows} rows of {model._meta.label}.{field.name}: "
+                    f"{size_before} -> {self.stored_size(model, field)} bytes"
+                )
+
+    @staticmethod
+    def stored_size(model: type[models.Model], field: models.Field) -> int:
+        return (
+            model._base_manager.aggregate(size=models.Sum(Length(field.attname)))["size"]
+            or 0
+        )
+
+    @staticmethod
+    def rewrite(model: type[models.Model], field: models.Field, batch_size: int) -> int:
+        """
+        Rewrites the values of `field`, in batches of `batch_size` rows by primary key.
+
+        Values are read decompressed and written back through the field, which compresses them as currently
+        configured. Each batch is locked while it is rewritten, so concurrent saves aren't overwritten with
+        stale values.
+        """
+        queryset = model._base_manager.filter(**{f"{field.attname}__isnull": False}).order_by("pk")
+        last_pk = None
+        total = 0
+        while True:
+            with transaction.atomic():
+                batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+                rows = list(
+                    batch.select_for_update().values_list("pk", field.attname)[:batch_size]
+                )
+                if not rows:
+                    return total
+                model._base_manager.filter(pk__in=[pk for pk, _ in rows]).update(
+                    **{
+                        field.attname: models.Case(
+                            *(
+                                models.When(pk=pk, then=models.Value(value, output_field=field))
+                                for pk, value in rows
+                            ),
+                            default=models.F(field.attname),
+                            output_field=field,
+                        )
+                    }
+                )
+            last_pk = rows[-1][0]
+            total += len(rows)
@@ -0,0 +1,11 @@
+from channels.management.commands import runworker
+
+from pycrdt_model.consumers import SaverWorker
+
+
+class Command(runworker.Command):
+    help = (
+        "Runs a channels worker, like runworker, but starts the saver worker consumers straight away so they "
+        "save the updates left in their pending buffer"
+    )
+    worker_class = SaverWorker
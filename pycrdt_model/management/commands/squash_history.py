@@ -0,0 +1,64 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from pycrdt_model.models import History
+
+
+class Command(BaseCommand):
+    help = (
+        "Squashes old history, merging consecutive entries by the same author into one entry per interval"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than-days",
+            type=float,
+            default=30,
+            help="Only squash entries older than this many days",
+        )
+        parser.add_argument(
+            "--interval-minutes",
+            type=float,
+            default=60,
+            help="Merge each author's consecutive entries down to at most one per this many minutes",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Entries to process per transaction",
+        )
+
+    def handle(
+        self,
+        *args,
+        older_than_days: float,
+        interval_minutes: float,
+        batch_size: int,
+        **options,
+    ):
+        if interval_minutes <= 0:
+            raise CommandError("--interval-minutes must be positive")
+        if batch_size < 2:
+            raise CommandError("--batch-size must be at least 2")
+        before = timezone.now() - timedelta(days=older_than_days)
+        interval = timedelta(minutes=interval_minutes)
+        targets = (
+            History.objects.filter(time__lt=before)
+            .order_by()
+            .values_list("target_type", "target_id")
+            .distinct()
+        )
+        total = 0
+        for target_type, target_id in targets.iterator():
+            removed = History.squash(
+                target_type, target_id, before, interval, batch_size=batch_size
+            )
+            if removed:
+                self.stdout.write(
+                    f"Squashed {removed} entries of target {target_type}/{target_id}"
+                )
+            total += removed
+        self.stdout.write(f"Squashed {total} history entries")
@@ -0,0 +1,233 @@
+"""
+Counters, gauges and histograms for the collaborative editing hot paths.
+
+Instrumented code calls `increment`, `set_gauge`, `observe` or `timer`, which pass the measurement on to the
+configured `MetricsSink`. The default sink ignores everything. Set `YJS_METRICS_SINK` to the dotted path of
+a sink class to collect them, e.g. `"pycrdt_model.metrics.Registry"` to keep them in memory and scrape them
+in the Prometheus text format, from `serve` on an internal port, or from `metrics_view`, which is only
+served to staff users.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import math
+import threading
+import time
+from typing import Iterator, Mapping
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, HttpRequest, HttpResponse
+from django.utils.module_loading import import_string
+
+Labels = Mapping[str, str] | None
+_LabelKey = tuple[tuple[str, str], ...]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricsSink:
+    """
+    Receives measurements. This base class ignores them; subclass it to send them somewhere.
+
+    Methods may be called from any thread.
+    """
+
+    def increment(self, name: str, value: float = 1.0, labels: Labels = None) -> None:
+        """
+        Adds `value` to a counter.
+        """
+
+    def set_gauge(self, name: str, value: float | None, labels: Labels = None) -> None:
+        """
+        Sets a gauge, or removes it if `value` is `None`.
+        """
+
+    def observe(self, name: str, value: float, labels: Labels = None) -> None:
+        """
+        Records a value, usually a duration in seconds, in a histogram.
+        """
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, buckets: int) -> None:
+        # Per bucket, not cumulative. The last one is +Inf.
+        self.counts = [0] * (buckets + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Registry(MetricsSink):
+    """
+    Keeps metrics in memory, to be rendered in the Prometheus text exposition format by `render`.
+    """
+
+    buckets: tuple[float, ...] = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+    )
+
+    lock: threading.Lock
+    counters: dict[str, dict[_LabelKey, float]]
+    gauges: dict[str, dict[_LabelKey, float]]
+    histograms: dict[str, dict[_LabelKey, _Histogram]]
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(labels: Labels) -> _LabelKey:
+        return tuple(sorted(labels.items())) if labels else ()
+
+    def increment(self, name: str, value: float = 1.0, labels: Labels = None) -> None:
+        key = self._key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def set_gauge(self, name: str, value: float | None, labels: Labels = None) -> None:
+        key = self._key(labels)
+        with self.lock:
+            series = self.gauges.setdefault(name, {})
+            if value is None:
+                series.pop(key, None)
+            else:
+                series[key] = value
+
+    def observe(self, name: str, value: float, labels: Labels = None) -> None:
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(len(self.buckets))
+            histogram.counts[index] += 1
+            histogram.sum += value
+            histogram.count += 1
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                for name, values in sorted(metrics.items()):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for key, value in sorted(values.items()):
+                        lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+            for name, histograms in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in sorted(histograms.items()):
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + (math.inf,), histogram.counts):
+                        cumulative += count
+                        le = (("le", "+Inf" if bound == math.inf else _format_value(bound)),)
+                        lines.append(f"{name}_bucket{_format_labels(key + le)} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {_format_value(histogram.sum)}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(key: _LabelKey) -> str:
+    if not key:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in key
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+_sink: MetricsSink | None = None
+
+
+def get_sink() -> MetricsSink:
+    """
+    Gets the sink, creating it from the `YJS_METRICS_SINK` setting on first use.
+    """
+    global _sink
+    if _sink is None:
+        path = getattr(settings, "YJS_METRICS_SINK", None)
+        _sink = import_string(path)() if path else MetricsSink()
+    return _sink
+
+
+def set_sink(sink: MetricsSink | None) -> None:
+    """
+    Replaces the sink. With `None`, it is created from settings again on next use.
+    """
+    global _sink
+    _sink = sink
+
+
+def increment(name: str, value: float = 1.0, labels: Labels = None) -> None:
+    get_sink().increment(name, value, labels)
+
+
+def set_gauge(name: str, value: float | None, labels: Labels = None) -> None:
+    get_sink().set_gauge(name, value, labels)
+
+
+def observe(name: str, value: float, labels: Labels = None) -> None:
+    get_sink().observe(name, value, labels)
+
+
+@contextmanager
+def timer(name: str, labels: Labels = None) -> Iterator[None]:
+    """
+    Observes the time taken by the block, in seconds.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, labels)
+
+
+def _render() -> str:
+    sink = get_sink()
+    if not isinstance(sink, Registry):
+        raise Http404("Metrics are not collected in a Registry")
+    return sink.render()
+
+
+@staff_member_required
+def metrics_view(request: HttpRequest) -> HttpResponse:
+    """
+    Serves the `Registry`'s metrics to staff users. Scrapers without a staff session should use `serve`.
+    """
+    return HttpResponse(_render(), content_type=CONTENT_TYPE)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        try:
+            body = _render().encode()
+        except Http404:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def serve(port: int, address: str = "") -> ThreadingHTTPServer:
+    """
+    Serves the `Registry`'s metrics over HTTP on `port`, from a daemon thread.
+    """
+    server = ThreadingHTTPServer((address, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.15 on 2026-10-16 22:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("contenttypes", "0002_remove_content_type_name"),
+        ("pycrdt_model", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="HistorySnapshot",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("target_id", models.PositiveIntegerField()),
+                ("state", models.BinaryField()),
+                (
+                    "history",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="pycrdt_model.history",
+                    ),
+                ),
+                (
+                    "target_type",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="contenttypes.contenttype",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["target_type", "target_id", "history"],
+                        name="pycrdt_mode_target__0cf8c6_idx",
+                    )
+                ],
+            },
+        ),
+    ]
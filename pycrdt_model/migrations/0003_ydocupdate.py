@@ -0,0 +1,38 @@
+# Generated by Django 5.1.15 on 2026-10-16 22:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("contenttypes", "0002_remove_content_type_name"),
+        ("pycrdt_model", "0002_historysnapshot"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="YDocUpdate",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("target_id", models.PositiveIntegerField()),
+                ("update", models.BinaryField()),
+                (
+                    "target_type",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="contenttypes.contenttype",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["target_type", "target_id", "id"],
+                        name="pycrdt_mode_target__53ba79_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.15 on 2026-10-16 23:37
+
+import pycrdt_model.models
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pycrdt_model", "0003_ydocupdate"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="history",
+            name="update",
+            field=pycrdt_model.models.CompressedBinaryField(),
+        ),
+        migrations.AlterField(
+            model_name="historysnapshot",
+            name="state",
+            field=pycrdt_model.models.CompressedBinaryField(),
+        ),
+        migrations.AlterField(
+            model_name="ydocupdate",
+            name="update",
+            field=pycrdt_model.models.CompressedBinaryField(),
+        ),
+    ]
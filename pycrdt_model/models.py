@@ -1,5 +1,9 @@
-from typing import Any, Generic, Self, TypeVar
+from datetime import datetime, timedelta
+from itertools import groupby
+from typing import Any, Generic, Iterable, Iterator, Mapping, NamedTuple, Self, TypeVar
 from django.db import models, transaction
+from django.db.models.functions import Length
+from django.db.models.query_utils import DeferredAttribute
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
@@ -7,10 +11,83 @@ from django.core.exceptions import FieldDoesNotExist
 from django.core import checks
 import pycrdt._base
 
+from pycrdt_model import compression
+from pycrdt_model.signals import history_squashed
+
 
 T = TypeVar("T")
 V = TypeVar("V", bound=T)
 
+
+class CompressedBinaryField(models.BinaryField):
+    """
+    `BinaryField` for yjs blobs, compressed when written if `YJS_COMPRESSION` is set and decompressed when
+    read. See `pycrdt_model.compression`.
+    """
+
+    def from_db_value(self, value, _expression, _connection):
+        if value is None:
+            return None
+        return compression.decompress(bytes(value))
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if value is None:
+            return None
+        return compression.compress(bytes(value))
+
+
+class HistoryEvent(NamedTuple):
+    """
+    Change observed on a top level doc value while replaying a `History` entry.
+
+    `delta` and `keys` are copied from the pycrdt event, and are `None` if the event type doesn't have them.
+    """
+
+    is_text: bool
+    path: list[int | str]
+    delta: list[dict[str, Any]] | None
+    keys: dict[str, Any] | None
+
+class TargetQuerySet(models.QuerySet):
+    """
+    `QuerySet` for models that refer to a `YDocModel` through `target_type` and `target_id`.
+    """
+
+    def for_ids(self, content_type_id: int, pk: Any) -> Self:
+        """
+        Filters to the rows of one object, by its content type ID and primary key.
+
+        Doesn't need the object or a content type lookup; use `YDocModel.yjs_content_type_id` to get the ID.
+        """
+        return self.filter(target_type_id=content_type_id, target_id=pk)
+
+
+_content_type_ids: dict[type[models.Model], int] = {}
+
+
+def clear_content_type_ids(**kwargs) -> None:
+    """
+    Clears the content type IDs cached by `YDocModel.yjs_content_type_id`.
+
+    Connected to `post_migrate`, since migrating or flushing the database can recreate content types.
+    """
+    _content_type_ids.clear()
+
+
+class HistoryPage(NamedTuple):
+    """
+    Page of `History` entries from `History.page_for_object`, most recent first.
+
+    `has_newer` and `has_older` say whether there are entries before or after the page. To get those pages,
+    pass the ID of the first entry as `after`, or of the last entry as `before`.
+    """
+
+    entries: list["History"]
+    has_newer: bool
+    has_older: bool
+
+
 class History(models.Model):
     """
     Change of a `YDocModelWithHistory`.
@@ -22,7 +99,9 @@ class History(models.Model):
     target = GenericForeignKey("target_type", "target_id")
     author = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
     time = models.DateTimeField(auto_now_add=True)
-    update = models.BinaryField()
+    update = CompressedBinaryField()
+
+    objects = TargetQuerySet.as_manager()
 
     class Meta:
         indexes = [
@@ -40,10 +119,40 @@ class History(models.Model):
         It's recommended to bound time based on the `id` field since its monotonically increasing and
         has no conflicts.
         """
-        return cls.objects.filter(
-            target_type=ContentType.objects.get_for_model(obj),
-            target_id=obj.pk,
-        ).order_by("-id" if recent_first else "id")
+        return cls.objects.for_ids(obj.yjs_content_type_id(), obj.pk).order_by("-id" if recent_first else "id")
+
+    @classmethod
+    def page_for_object(
+        cls,
+        obj: "YDocModelWithHistory",
+        size: int,
+        before: int | None = None,
+        after: int | None = None,
+    ) -> HistoryPage:
+        """
+        Gets a page of `size` history entries for an object, most recent first.
+
+        The page has the most recent entries with IDs less than `before`, or the oldest with IDs greater than
+        `after`, or the most recent overall if neither is set. Pages are found by ID range on the
+        `(target_type, target_id, id)` index, so unlike `Paginator` there is no `COUNT` and deep pages cost
+        the same as the first.
+        """
+        qs = cls.for_object(obj)
+        if after is not None:
+            entries = list(qs.filter(id__gt=after)[: size + 1])
+            has_newer = len(entries) > size
+            entries = entries[:size][::-1]
+            has_older = qs.filter(id__lte=after).exists()
+            return HistoryPage(entries, has_newer, has_older)
+
+        qs = qs.reverse()
+        if before is not None:
+            entries = list(qs.filter(id__lt=before)[: size + 1])
+            has_newer = cls.for_object(obj).filter(id__gte=before).exists()
+        else:
+            entries = list(qs[: size + 1])
+            has_newer = False
+        return HistoryPage(entries[:size], has_newer, len(entries) > size)
 
     @classmethod
     def replay(
@@ -51,15 +160,19 @@ class History(models.Model):
     ) -> pycrdt.Doc:
         """
         Gets a `pycrdt.Doc` with the state at the time of the last update at or until `until_id`.
+
+        Starts from the nearest `HistorySnapshot` and only applies the entries after it.
         """
-        doc = pycrdt.Doc()
+        qs = cls.for_object(obj)
+        if until_id_inclusive:
+            qs = qs.filter(id__lte=until_id)
+        else:
+            qs = qs.filter(id__lt=until_id)
+        doc, snapshot_history_id = HistorySnapshot.load_nearest(
+            obj, until_id, until_id_inclusive
+        )
         with doc.transaction():
-            qs = cls.for_object(obj)
-            if until_id_inclusive:
-                qs = qs.filter(id__lte=until_id)
-            else:
-                qs = qs.filter(id__lt=until_id)
-            for history_entry in qs:
+            for history_entry in qs.filter(id__gt=snapshot_history_id):
                 doc.apply_update(history_entry.update)
         return doc
 
@@ -77,10 +190,15 @@ class History(models.Model):
 
         If there is no `History` with the passed in `history_id`, returns None.
         """
-        doc = pycrdt.Doc()
+        doc, snapshot_history_id = HistorySnapshot.load_nearest(
+            obj, history_id, inclusive=False
+        )
         last_entry = None
         with doc.transaction():
-            for history_entry in cls.for_object(obj).filter(id__lte=history_id):
+            qs = cls.for_object(obj).filter(
+                id__gt=snapshot_history_id, id__lte=history_id
+            )
+            for history_entry in qs:
                 if last_entry is not None:
                     doc.apply_update(last_entry.update)
                 last_entry = history_entry
@@ -89,18 +207,301 @@ class History(models.Model):
         return (doc, last_entry)
 
 
+    @classmethod
+    def replay_range(
+        cls,
+        obj: "YDocModelWithHistory",
+        start_id: int,
+        end_id: int,
+        roots: Mapping[str, type] | None = None,
+        chunk_size: int = 100,
+    ) -> Iterator[tuple[Self | None, pycrdt.Doc, dict[str, list[HistoryEvent]]]]:
+        """
+        Replays the history entries with IDs from `start_id` to `end_id` (inclusive), one at a time.
+
+        First yields `(None, doc, events)` with the state just before the first entry in the range, even if
+        the range has no entries, then `(entry, doc, events)` after applying each entry. `roots` maps top level doc keys to their types (as
+        passed to `pycrdt.Doc.get`) to observe, and `events` maps each of those keys to the changes the entry
+        made to it.
+
+        The doc is built from the nearest `HistorySnapshot`, and the entries are streamed in one query with
+        `QuerySet.iterator`, so memory stays bounded however long the range is. The doc and events are
+        reused, so they are only valid until the next item is requested.
+        """
+        roots = roots or {}
+        doc, snapshot_history_id = HistorySnapshot.load_nearest(
+            obj, start_id, inclusive=False
+        )
+        events: dict[str, list[HistoryEvent]] = {key: [] for key in roots}
+        subscriptions: list[tuple[Any, pycrdt.Subscription]] = []
+        started = False
+        qs = cls.for_object(obj).filter(id__gt=snapshot_history_id, id__lte=end_id)
+        try:
+            for entry in qs.iterator(chunk_size=chunk_size):
+                if entry.id < start_id:
+                    doc.apply_update(entry.update)
+                    continue
+                if not started:
+                    started = True
+                    for key, typ in roots.items():
+                        root: Any = doc.get(key, type=typ)
+                        subscriptions.append(
+                            (root, root.observe_deep(_history_event_collector(events[key])))
+                        )
+                    yield (None, doc, events)
+                doc.apply_update(entry.update)
+                yield (entry, doc, events)
+                for key_events in events.values():
+                    key_events.clear()
+            if not started:
+                yield (None, doc, events)
+        finally:
+            for root, subscription in subscriptions:
+                root.unobserve(subscription)
+
+    @classmethod
+    def save_entries(
+        cls, entries: Iterable[tuple["YDocModelWithHistory", list[Self]]]
+    ) -> None:
+        """
+        Inserts unsaved entries for each of several objects with one `bulk_create`, then takes any snapshots
+        that are due.
+
+        Sets the target of each entry to its object, which must already be saved.
+        """
+        entries = list(entries)
+        for obj, obj_entries in entries:
+            content_type_id = obj.yjs_content_type_id()
+            for entry in obj_entries:
+                entry.target_type_id = content_type_id
+                entry.target_id = obj.pk
+        cls.objects.bulk_create(
+            [entry for _, obj_entries in entries for entry in obj_entries]
+        )
+        for obj, obj_entries in entries:
+            HistorySnapshot.create_if_due(obj, obj_entries[-1])
+
+    @classmethod
+    def squash(
+        cls,
+        target_type: ContentType | int,
+        target_id: int,
+        before: datetime,
+        interval: timedelta,
+        batch_size: int = 500,
+    ) -> int:
+        """
+        Merges runs of consecutive entries of an object by the same author into one entry per `interval`.
+
+        Only entries with a `time` earlier than `before` are squashed. Each run is replaced by its last entry,
+        with its update set to the merge of the whole run's updates, so replaying ends in the same states at
+        the entries that remain. Snapshots taken at the removed entries are deleted along with them.
+
+        Entries are processed `batch_size` at a time, each batch in its own transaction, after which
+        `history_squashed` is sent with the IDs of the entries that were rewritten.
+
+        Returns the number of entries removed.
+        """
+        if batch_size < 2:
+            raise ValueError("batch_size must be at least 2")
+        if interval <= timedelta(0):
+            raise ValueError("interval must be positive")
+        if isinstance(target_type, ContentType):
+            target_type = target_type.pk
+        seconds = interval.total_seconds()
+
+        def run_key(entry: History) -> tuple[int | None, int]:
+            return (entry.author_id, int(entry.time.timestamp() // seconds))
+
+        qs = cls.objects.filter(
+            target_type_id=target_type, target_id=target_id, time__lt=before
+        ).order_by("id")
+        removed = 0
+        cursor = 0
+        while True:
+            with transaction.atomic():
+                entries = list(
+                    qs.filter(id__gte=cursor)
+                    .select_for_update()
+                    .only("id", "author_id", "time", "update")[:batch_size]
+                )
+                squashed: list[History] = []
+                delete_ids: list[int] = []
+                for _, run in groupby(entries, key=run_key):
+                    run = list(run)
+                    if len(run) == 1:
+                        continue
+                    last = run[-1]
+                    last.update = pycrdt.merge_updates(
+                        *(bytes(entry.update) for entry in run)
+                    )
+                    squashed.append(last)
+                    delete_ids.extend(entry.id for entry in run[:-1])
+                if squashed:
+                    cls.objects.bulk_update(squashed, ["update"])
+                    cls.objects.filter(id__in=delete_ids).delete()
+                    removed += len(delete_ids)
+                    history_squashed.send(
+                        sender=cls,
+                        target_type=target_type,
+                        target_id=target_id,
+                        history_ids=[entry.id for entry in squashed],
+                    )
+            if len(entries) < batch_size:
+                return removed
+            # The last run may continue into the next batch, so start from its (remaining) entry
+            cursor = entries[-1].id
+
+
+def _history_event_collector(out: list[HistoryEvent]):
+    def callback(evs: list[Any]) -> None:
+        for ev in evs:
+            out.append(
+                HistoryEvent(
+                    isinstance(getattr(ev, "target", None), (pycrdt.Text, pycrdt.XmlText)),
+                    ev.path,
+                    getattr(ev, "delta", None),
+                    getattr(ev, "keys", None),
+                )
+            )
+
+    return callback
+
+
+class HistorySnapshot(models.Model):
+    """
+    Full encoded doc state of a `YDocModelWithHistory` as of a `History` entry (inclusive).
+
+    Checkpoints are written by `YDocModelWithHistory.save` every `history_snapshot_every_entries` entries
+    or `history_snapshot_every_bytes` bytes of updates, so that `History.replay` only has to apply the
+    entries after the nearest snapshot instead of the whole log.
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    target_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    target_id = models.PositiveIntegerField()
+    target = GenericForeignKey("target_type", "target_id")
+    history = models.ForeignKey(History, on_delete=models.CASCADE)
+    state = CompressedBinaryField()
+
+    objects = TargetQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["target_type", "target_id", "history"]),
+        ]
+
+    @classmethod
+    def for_object(cls, obj: "YDocModelWithHistory"):
+        """
+        Gets a `QuerySet` of snapshots for an object, ordered from most recent to oldest.
+        """
+        return cls.objects.for_ids(obj.yjs_content_type_id(), obj.pk).order_by("-history_id")
+
+    @classmethod
+    def load_nearest(
+        cls, obj: "YDocModelWithHistory", until_id: int, inclusive: bool = True
+    ) -> tuple[pycrdt.Doc, int]:
+        """
+        Loads the most recent snapshot at or before `until_id` (or strictly before, if `inclusive` is False).
+
+        Returns the doc and the ID of the `History` entry the snapshot was taken at. If there is no such
+        snapshot, returns an empty doc and zero.
+        """
+        qs = cls.for_object(obj)
+        if inclusive:
+            qs = qs.filter(history_id__lte=until_id)
+        else:
+            qs = qs.filter(history_id__lt=until_id)
+        doc = pycrdt.Doc()
+        snapshot = qs.only("history_id", "state").first()
+        if snapshot is None:
+            return (doc, 0)
+        doc.apply_update(snapshot.state)
+        return (doc, snapshot.history_id)
+
+    @classmethod
+    def create_if_due(
+        cls, obj: "YDocModelWithHistory", history: History
+    ) -> "HistorySnapshot | None":
+        """
+        Creates a snapshot at `history` if enough entries or bytes have accumulated since the last one.
+
+        The snapshot is built by replaying history rather than taken from `obj.yjs_doc`, so that it stays
+        consistent with the log even if the in-memory doc missed a concurrent save.
+        """
+        last = cls.for_object(obj).values_list("history_id", flat=True).first() or 0
+        since = (
+            History.for_object(obj)
+            .filter(id__gt=last, id__lte=history.id)
+            .aggregate(count=models.Count("id"), size=models.Sum(Length("update")))
+        )
+        every_entries = obj.history_snapshot_every_entries
+        every_bytes = obj.history_snapshot_every_bytes
+        if not (
+            (every_entries is not None and since["count"] >= every_entries)
+            or (every_bytes is not None and (since["size"] or 0) >= every_bytes)
+        ):
+            return None
+        doc = History.replay(obj, history.id)
+        return cls.objects.create(
+            target_type_id=obj.yjs_content_type_id(),
+            target_id=obj.pk,
+            history=history,
+            state=doc.get_update(),
+        )
+
 
 # models.Field[pycrdt.Doc, pycrdt.Doc]
+class YDocFieldDescriptor(DeferredAttribute):
+    """
+    Descriptor used with YDocField, decoding the stored bytes into a `pycrdt.Doc` on first access.
+
+    Once decoded (or when a doc is assigned), calls the instance's `_ydoc_loaded` method, if it has
+    one, with the field and whether the doc came from the database.
+    """
+
+    def __get__(self, instance: models.Model | None, cls: Any = None):
+        if instance is None:
+            return self
+        value = super().__get__(instance, cls)
+        if not isinstance(value, (bytes, memoryview)):
+            return value
+        doc = pycrdt.Doc(client_id=0)
+        doc.apply_update(value)
+        instance.__dict__[self.field.attname] = doc
+        self._loaded(instance, True)
+        return doc
+
+    def __set__(self, instance: models.Model, value: Any) -> None:
+        instance.__dict__[self.field.attname] = value
+        if isinstance(value, pycrdt.Doc):
+            self._loaded(instance, False)
+
+    def _loaded(self, instance: models.Model, from_db: bool) -> None:
+        callback = getattr(instance, "_ydoc_loaded", None)
+        if callback is not None:
+            callback(self.field, from_db)
+
+
 class YDocField(models.Field):
     """
     Django field for a yjs document.
 
     The document's client id will be set to zero.
+
+    Decoding is lazy: rows are loaded with the encoded bytes, which are only turned into a `pycrdt.Doc`
+    when the attribute is first accessed. Saving an instance whose doc was never accessed writes the
+    bytes back as-is. Querysets using `values()` get the encoded bytes.
+
+    The bytes are stored compressed if `YJS_COMPRESSION` is set, see `pycrdt_model.compression`, and
+    decompressed as rows are loaded.
     """
     # Based off of Django's BinaryField
 
     description = "YJS Document"
     empty_values = [None]
+    descriptor_class = YDocFieldDescriptor
 
     def __init__(self, *args, **kwargs):
         kwargs.setdefault("editable", False)
@@ -121,14 +522,29 @@ class YDocField(models.Field):
     ):
         if value is None:
             return None
-        doc = pycrdt.Doc(client_id=0)
-        doc.apply_update(value)
-        return doc
+        return compression.decompress(bytes(value))
+
+    def is_loaded(self, instance: models.Model) -> bool:
+        """
+        Whether the doc of `instance` has been decoded or assigned, i.e. may have changed since it was loaded.
+        Not if the field was deferred and hasn't been accessed since.
+        """
+        return self.attname in instance.__dict__ and not isinstance(
+            instance.__dict__[self.attname], (bytes, memoryview)
+        )
+
+    def pre_save(self, model_instance, add):
+        # Don't decode just to re-encode an untouched doc
+        if self.attname in model_instance.__dict__:
+            return model_instance.__dict__[self.attname]
+        return super().pre_save(model_instance, add)
 
     def get_prep_value(self, value):
         if value is None:
             return None
-        return value.get_update()
+        if isinstance(value, (bytes, memoryview)):
+            return compression.compress(bytes(value))
+        return compression.compress(value.get_update())
 
     def get_db_prep_value(self, value, connection, prepared=False):
         value = super().get_db_prep_value(value, connection, prepared)
@@ -145,18 +561,151 @@ class YDocField(models.Field):
 
 
 
+class YDocUpdate(models.Model):
+    """
+    Update to a `YDocModel` stored in incremental mode, not yet compacted into its `yjs_doc` column.
+
+    See `YDocModel.yjs_incremental_storage`.
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    target_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    target_id = models.PositiveIntegerField()
+    target = GenericForeignKey("target_type", "target_id")
+    update = CompressedBinaryField()
+
+    objects = TargetQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["target_type", "target_id", "id"]),
+        ]
+
+    @classmethod
+    def for_object(cls, obj: "YDocModel"):
+        """
+        Gets a `QuerySet` of the uncompacted updates of an object, from first to last.
+        """
+        return cls.objects.for_ids(obj.yjs_content_type_id(), obj.pk).order_by("id")
+
+
 class YDocModel(models.Model):
     """
     Base class for models that contains a YDoc.
 
     Adds `yjs_doc` field, and copies `YField`s to their configured `copy_to_field` when saving.
+
+    Incremental storage
+    -------------------
+
+    By default, every save re-encodes and rewrites the whole doc. If `yjs_incremental_storage` is set,
+    saves of existing rows instead append the change as a small `YDocUpdate` row and leave the
+    `yjs_doc` column alone. Loading applies those rows on top of the stored doc.
+
+    Once more than `yjs_compact_after_updates` rows or `yjs_compact_after_bytes` bytes have piled up,
+    `yjs_compaction_due` becomes true, and `compact_yjs_updates` should be called (the
+    `YjsSaverWorkerConsumer` does this after saving) to merge them back into the `yjs_doc` column.
     """
 
     class Meta:
         abstract = True
 
+    yjs_incremental_storage: bool = False
+    yjs_compact_after_updates: int = 100
+    yjs_compact_after_bytes: int = 1024 * 1024
+
     yjs_doc: pycrdt.Doc = YDocField()
 
+    # State vector of the doc as stored in the database, and the uncompacted updates that went into it.
+    _yjs_stored_state: bytes | None
+    _yjs_update_count: int
+    _yjs_update_bytes: int
+    _yjs_last_update_id: int | None
+
+    def __init__(self, *args, **kwargs):
+        self._yjs_update_count = 0
+        self._yjs_update_bytes = 0
+        self._yjs_last_update_id = None
+        super().__init__(*args, **kwargs)
+
+    @classmethod
+    def yjs_content_type_id(cls) -> int:
+        """
+        ID of this model's `ContentType`, as stored in the `target_type` of its `History`, `HistorySnapshot`
+        and `YDocUpdate` rows.
+
+        Looked up once per process (until the next migration or flush) rather than through Django's
+        content type cache, so the save path only has to touch the tables it writes to.
+        """
+        try:
+            return _content_type_ids[cls]
+        except KeyError:
+            content_type_id = ContentType.objects.get_for_model(cls).pk
+            _content_type_ids[cls] = content_type_id
+            return content_type_id
+
+    def _ydoc_loaded(self, field: YDocField, from_db: bool) -> None:
+        """
+        Called by `YDocFieldDescriptor` once `yjs_doc` is decoded or assigned.
+        """
+        if field.attname != "yjs_doc":
+            return
+        if from_db and self.yjs_incremental_storage:
+            self._load_yjs_updates()
+        self._yjs_doc_loaded()
+
+    def _yjs_doc_loaded(self) -> None:
+        """
+        Called once `yjs_doc` holds the state stored in the database.
+        """
+        if self.yjs_incremental_storage:
+            self._yjs_stored_state = self.yjs_doc.get_state()
+
+    @property
+    def yjs_doc_loaded(self) -> bool:
+        """
+        Whether `yjs_doc` has been decoded (or assigned). If not, it can't have changed since it was loaded.
+        """
+        return self._meta.get_field("yjs_doc").is_loaded(self)
+
+    def _load_yjs_updates(self) -> None:
+        with self.yjs_doc.transaction():
+            for pk, update in YDocUpdate.for_object(self).values_list("pk", "update"):
+                self.yjs_doc.apply_update(update)
+                self._yjs_update_count += 1
+                self._yjs_update_bytes += len(update)
+                self._yjs_last_update_id = pk
+
+    @property
+    def yjs_compaction_due(self) -> bool:
+        """
+        Whether enough `YDocUpdate` rows have accumulated that `compact_yjs_updates` should be called.
+        """
+        return self.yjs_incremental_storage and (
+            self._yjs_update_count >= self.yjs_compact_after_updates
+            or self._yjs_update_bytes >= self.yjs_compact_after_bytes
+        )
+
+    @classmethod
+    def compact_yjs_updates(cls, pk: Any) -> None:
+        """
+        Merges the `YDocUpdate` rows of an object into its `yjs_doc` column, then deletes them.
+
+        Applying an update twice is harmless, but a reader that loaded the old column just before
+        compaction and its updates just after will miss them, so loads that feed a save should
+        happen under `select_for_update`, as the saver worker's do.
+        """
+        with transaction.atomic():
+            instance = cls._default_manager.select_for_update().get(pk=pk)
+            # Decodes the doc, applying the updates
+            instance.yjs_doc
+            if instance._yjs_last_update_id is None:
+                return
+            cls._default_manager.filter(pk=pk).update(yjs_doc=instance.yjs_doc)
+            YDocUpdate.for_object(instance).filter(
+                id__lte=instance._yjs_last_update_id
+            ).delete()
+
     def copy_y_fields(self):
         """
         Copies fields from the ydoc to the Django field, as configured by its `YField`s.
@@ -168,8 +717,52 @@ class YDocModel(models.Model):
                 field._do_copy_to_field(self)
 
     def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if not self.yjs_doc_loaded:
+            # Doc is untouched, so neither it nor the copied fields need saving
+            if not self._state.adding and update_fields is None:
+                kwargs["update_fields"] = [
+                    field.attname
+                    for field in self._meta.concrete_fields
+                    if not field.primary_key and field.attname != "yjs_doc"
+                ]
+            return super().save(*args, **kwargs)
+
         self.copy_y_fields()
-        return super().save(*args, **kwargs)
+        if (
+            not self.yjs_incremental_storage
+            or self._state.adding
+            or (update_fields is not None and "yjs_doc" not in update_fields)
+        ):
+            super().save(*args, **kwargs)
+            if self.yjs_incremental_storage and (
+                update_fields is None or "yjs_doc" in update_fields
+            ):
+                self._yjs_stored_state = self.yjs_doc.get_state()
+            return
+
+        kwargs["update_fields"] = [
+            field.attname
+            for field in self._meta.concrete_fields
+            if not field.primary_key
+            and field.attname != "yjs_doc"
+            and (update_fields is None or field.attname in update_fields)
+        ]
+        state = self.yjs_doc.get_state()
+        if state == self._yjs_stored_state:
+            return super().save(*args, **kwargs)
+
+        update = self.yjs_doc.get_update(self._yjs_stored_state)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            YDocUpdate.objects.create(
+                target_type_id=self.yjs_content_type_id(),
+                target_id=self.pk,
+                update=update,
+            )
+        self._yjs_stored_state = state
+        self._yjs_update_count += 1
+        self._yjs_update_bytes += len(update)
 
 
 class YDocModelWithHistory(YDocModel):
@@ -177,38 +770,115 @@ class YDocModelWithHistory(YDocModel):
     `YDocModel` that saves a `History` entry every time its saved.
 
     When `save`ing, if the doc has changed, this will also create a `History` entry containing the
-    update from the state vector the model was loaded at to the state vector at time of saving. The
-    history's `user` field can be provided as a keyword argument.
+    update from the state vector the model was loaded at (computed when the doc is first accessed) to
+    the state vector at time of saving. The history's `user` field can be provided as a keyword argument.
+
+    A `HistorySnapshot` of the full doc state is also saved every `history_snapshot_every_entries`
+    history entries or `history_snapshot_every_bytes` bytes of updates, whichever comes first,
+    to bound the cost of `History.replay`. Set either to `None` to disable that trigger. Bytes are counted
+    as stored, i.e. after compression if `YJS_COMPRESSION` is set.
     """
 
     class Meta:
         abstract = True
 
+    history_snapshot_every_entries: int | None = 100
+    history_snapshot_every_bytes: int | None = 1024 * 1024
+
     _state_vector_at_load: bytes | None
+    _authored_updates: list[tuple[User | int | None, bytes]]
 
     def __init__(self, *args, **kwargs):
+        self._authored_updates = []
         super().__init__(*args, **kwargs)
+
+    def _yjs_doc_loaded(self) -> None:
+        super()._yjs_doc_loaded()
         self._state_vector_at_load = self.yjs_doc.get_state()
 
+    def apply_updates(
+        self, updates: Iterable[bytes], user: User | int | None = None
+    ) -> None:
+        """
+        Applies update blobs to the doc, attributing them to `user` in the history saved by the next `save`.
+
+        Each call is saved as its own `History` entry, so one `save` can record edits from several authors.
+        Direct edits made to the doc since the last call or save are attributed to `user` as well.
+        """
+        with self.yjs_doc.transaction():
+            for update in updates:
+                self.yjs_doc.apply_update(update)
+        state = self.yjs_doc.get_state()
+        if state == self._state_vector_at_load:
+            return
+        self._authored_updates.append(
+            (user, self.yjs_doc.get_update(self._state_vector_at_load))
+        )
+        self._state_vector_at_load = state
+
     def save(self, *args, user: User | int | None = None, **kwargs):
         """
         As Django's model save, but also saves a `History` entry for the update, if the doc changed.
 
         If `user` is provided (either its ID or the model itself), `History.author` will be set to the provided user.
+        Updates added through `apply_updates` are saved as separate entries with their own authors.
         """
-        if self._state_vector_at_load == self.yjs_doc.get_state():
+        if not self.yjs_doc_loaded:
+            return super().save(*args, **kwargs)
+
+        entries = self._build_history(user)
+        if not entries:
             # No actual changes with the doc, don't save a new history entry
             return super().save(*args, **kwargs)
 
-        update = self.yjs_doc.get_update(self._state_vector_at_load)
         with transaction.atomic():
             super().save(*args, **kwargs)
-            history = History(target=self, update=update)
-            if isinstance(user, int):
-                history.author_id = user
+            History.save_entries([(self, entries)])
+        self._history_saved()
+
+    @staticmethod
+    def save_many(instances: Iterable["YDocModelWithHistory"]) -> None:
+        """
+        Saves several instances, of any history models, in one transaction.
+
+        Each doc is saved as by `save` (without a `user`; use `apply_updates` to attribute changes), but the
+        `History` entries of all of them are written with a single `bulk_create`.
+        """
+        saved: list[tuple[YDocModelWithHistory, list[History]]] = []
+        with transaction.atomic():
+            for instance in instances:
+                entries = instance._build_history(None) if instance.yjs_doc_loaded else []
+                super(YDocModelWithHistory, instance).save()
+                if entries:
+                    saved.append((instance, entries))
+            History.save_entries(saved)
+        for instance, _ in saved:
+            instance._history_saved()
+
+    def _build_history(self, user: User | int | None) -> list[History]:
+        """
+        Makes unsaved `History` entries for the changes since the doc was loaded or last saved.
+
+        The target is left unset, since the instance may not have a primary key yet; see `History.save_entries`.
+        """
+        authored_updates = list(self._authored_updates)
+        if self.yjs_doc.get_state() != self._state_vector_at_load:
+            authored_updates.append(
+                (user, self.yjs_doc.get_update(self._state_vector_at_load))
+            )
+        entries = []
+        for author, update in authored_updates:
+            history = History(update=update)
+            if isinstance(author, int):
+                history.author_id = author
             else:
-                history.author = user
-            history.save()
+                history.author = author
+            entries.append(history)
+        return entries
+
+    def _history_saved(self) -> None:
+        self._state_vector_at_load = self.yjs_doc.get_state()
+        self._authored_updates = []
 
 
 def _resolve_path(doc: pycrdt.Doc, doc_value_path: str | list[str | int], typ: type[T], default: T | None = None) -> T | None:
@@ -0,0 +1,125 @@
+"""
+Durable buffers for the updates that `YjsSaverWorkerConsumer` holds in memory until they are saved.
+"""
+
+from typing import Any, NamedTuple
+
+
+class BufferedState(NamedTuple):
+    """
+    Updates of a pending state that were buffered but not saved, as returned by `RedisPendingBuffer.recover`.
+    """
+
+    key: str
+    model_label: str
+    doc_pk: Any
+    updates: list[tuple[int | None, bytes]]
+
+
+class RedisPendingBuffer:
+    """
+    Keeps a copy of every pending update in Redis, so that a worker that restarts can save them.
+
+    Each pending state's updates are appended to the list `<prefix>:<channel>:updates:<key>`, next to a hash
+    with the document it belongs to, and the state key is added to the `<prefix>:<channel>:keys` set.
+    After a save, the saved updates are trimmed off the front of the list. `channel` is the worker's channel,
+    so sharded workers each recover only their own states.
+
+    Each append or trim is sent as a single `MULTI` transaction, so it takes one round trip and a crash
+    can't leave a state half-registered.
+
+    `client` is a `redis.asyncio.Redis` (or compatible) client, without `decode_responses`.
+    """
+
+    client: Any
+    prefix: str
+
+    def __init__(self, client: Any, prefix: str = "yjs-pending") -> None:
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str, prefix: str = "yjs-pending") -> "RedisPendingBuffer":
+        import redis.asyncio
+
+        return cls(redis.asyncio.Redis.from_url(url), prefix)
+
+    def _keys_key(self, channel: str) -> str:
+        return f"{self.prefix}:{channel}:keys"
+
+    def _updates_key(self, channel: str, key: str) -> str:
+        return f"{self.prefix}:{channel}:updates:{key}"
+
+    def _meta_key(self, channel: str, key: str) -> str:
+        return f"{self.prefix}:{channel}:meta:{key}"
+
+    async def append(
+        self,
+        channel: str,
+        key: str,
+        user_pk: int | None,
+        update: bytes,
+        *,
+        model_label: str | None = None,
+        doc_pk: Any = None,
+    ) -> None:
+        """
+        Appends an update to a state's buffer.
+
+        Pass `model_label` and `doc_pk` with the first update of a state, to register it for recovery.
+        """
+        author = b"" if user_pk is None else str(user_pk).encode()
+        async with self.client.pipeline(transaction=True) as pipe:
+            if model_label is not None:
+                pipe.hset(
+                    self._meta_key(channel, key),
+                    mapping={"model": model_label, "pk": str(doc_pk)},
+                )
+                pipe.sadd(self._keys_key(channel), key)
+            pipe.rpush(self._updates_key(channel, key), author + b":" + update)
+            await pipe.execute()
+
+    async def trim(self, channel: str, key: str, count: int) -> None:
+        """
+        Drops the first `count` updates of a state's buffer, after they have been saved.
+
+        The state is unregistered along with the trim, as it usually has no updates left. If it does, it is
+        registered again with the metadata read in the same transaction.
+        """
+        updates_key = self._updates_key(channel, key)
+        meta_key = self._meta_key(channel, key)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.ltrim(updates_key, count, -1)
+            pipe.llen(updates_key)
+            pipe.hgetall(meta_key)
+            pipe.srem(self._keys_key(channel), key)
+            pipe.delete(meta_key)
+            _, remaining, meta, *_ = await pipe.execute()
+        if remaining and meta:
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.hset(meta_key, mapping={name.decode(): value.decode() for name, value in meta.items()})
+                pipe.sadd(self._keys_key(channel), key)
+                await pipe.execute()
+
+    async def recover(self, channel: str) -> list[BufferedState]:
+        """
+        Gets the buffered updates of every state that wasn't saved.
+        """
+        states = []
+        for key in await self.client.smembers(self._keys_key(channel)):
+            key = key.decode()
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.hgetall(self._meta_key(channel, key))
+                pipe.lrange(self._updates_key(channel, key), 0, -1)
+                meta, entries = await pipe.execute()
+            if not meta or not entries:
+                await self.trim(channel, key, len(entries))
+                continue
+            updates = []
+            for entry in entries:
+                author, _, update = bytes(entry).partition(b":")
+                updates.append((int(author) if author else None, update))
+            states.append(
+                BufferedState(key, meta[b"model"].decode(), meta[b"pk"].decode(), updates)
+            )
+        return states
@@ -0,0 +1,116 @@
+"""
+Exporters for the saver worker's profiling hooks, the `pending_*` signals in `pycrdt_model.signals`.
+
+Set `YJS_SPAN_EXPORTER` to the dotted path of an exporter class, e.g.
+`"pycrdt_model.profiling.LoggingSpanExporter"`, to have one connected when the app is ready.
+"""
+
+import json
+import logging
+import secrets
+import threading
+import time
+from typing import Any
+
+from pycrdt_model.signals import pending_post_save, pending_pre_load
+
+
+class LoggingSpanExporter:
+    """
+    Logs every save of the saver worker as a span, with a child span per phase, to the `pycrdt_model.spans`
+    logger at INFO level.
+
+    Each span is logged as a JSON object on its own line, shaped like an OpenTelemetry span: `name`,
+    `trace_id`, `span_id`, `parent_span_id`, `start_time_unix_nano`, `end_time_unix_nano` and `attributes`.
+    """
+
+    logger: logging.Logger = logging.getLogger("pycrdt_model.spans")
+
+    local: threading.local
+
+    def __init__(self) -> None:
+        self.local = threading.local()
+
+    def connect(self) -> None:
+        pending_pre_load.connect(self.on_pre_load, dispatch_uid=f"{type(self).__name__}-{id(self)}")
+        pending_post_save.connect(self.on_post_save, dispatch_uid=f"{type(self).__name__}-{id(self)}")
+
+    def disconnect(self) -> None:
+        pending_pre_load.disconnect(dispatch_uid=f"{type(self).__name__}-{id(self)}")
+        pending_post_save.disconnect(dispatch_uid=f"{type(self).__name__}-{id(self)}")
+
+    def on_pre_load(self, sender: Any, **kwargs) -> None:
+        # Signals of one save are sent from the same thread
+        self.local.start = time.time_ns()
+
+    def on_post_save(
+        self,
+        sender: Any,
+        states: list[Any],
+        update_bytes: int,
+        timings: dict[str, float],
+        **kwargs,
+    ) -> None:
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        start = getattr(self.local, "start", None)
+        if start is None:
+            return
+        trace_id = secrets.token_hex(16)
+        root_id = secrets.token_hex(8)
+        end = start + int(sum(timings.values()) * 1e9)
+        self.export(
+            "pycrdt_model.save",
+            trace_id,
+            root_id,
+            None,
+            start,
+            end,
+            {
+                "states": len(states),
+                "keys": [state.key for state in states],
+                "update_bytes": update_bytes,
+            },
+        )
+        phase_start = start
+        elapsed = 0.0
+        for phase, seconds in timings.items():
+            elapsed += seconds
+            phase_end = start + int(elapsed * 1e9)
+            self.export(
+                f"pycrdt_model.save.{phase}",
+                trace_id,
+                secrets.token_hex(8),
+                root_id,
+                phase_start,
+                phase_end,
+                {},
+            )
+            phase_start = phase_end
+
+    def export(
+        self,
+        name: str,
+        trace_id: str,
+        span_id: str,
+        parent_span_id: str | None,
+        start: int,
+        end: int,
+        attributes: dict[str, Any],
+    ) -> None:
+        """
+        Logs one span. Override to send spans elsewhere.
+        """
+        self.logger.info(
+            json.dumps(
+                {
+                    "name": name,
+                    "trace_id": trace_id,
+                    "span_id": span_id,
+                    "parent_span_id": parent_span_id,
+                    "start_time_unix_nano": start,
+                    "end_time_unix_nano": end,
+                    "attributes": attributes,
+                }
+            )
+        )
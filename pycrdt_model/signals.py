@@ -0,0 +1,17 @@
+from django.dispatch import Signal
+
+# Sent by `History.squash` after each batch it squashes, with `target_type` (content type ID), `target_id`,
+# and `history_ids`: the entries whose update was replaced by a merge of it and the entries before it.
+# Anything derived from those entries' updates, such as rendered diffs, is out of date.
+history_squashed = Signal()
+
+# Profiling hooks around the saves done by `YjsSaverWorkerConsumer`, in `_PendingState.save_many`. All are sent
+# from the thread running the save, with the `states` being saved and `update_bytes`, the size of their updates.
+# Sent before the documents are locked and loaded.
+pending_pre_load = Signal()
+# Sent once the updates are applied, also with the loaded `instances` and `timings`: seconds taken by the
+# `lock`, `load` and `apply` phases.
+pending_post_apply = Signal()
+# Sent once the transaction saving the documents has committed, with the same arguments as
+# `pending_post_apply`, with the `save` phase added to `timings`.
+pending_post_save = Signal()